@@ -0,0 +1,571 @@
+"""Offline load simulation for bot.py.
+
+Builds the same Application the bot runs, but points it at a fake Bot API
+and a local mongod, then drives synthetic users through
+register -> search -> chat -> next -> stop. Prints per-step p50/p99 latency,
+Mongo commands and Bot API calls per update, and memory growth, so every
+change to bot.py can be compared run to run.
+
+    python bench.py --users 2000 --concurrency 200
+    python bench.py --users 4000 --workers 1,2,4
+    MONGO_URI=mongodb://localhost:27017 python bench.py --api-latency 30 --top 15
+
+The bench database is dropped before each run (use --keep to reuse it).
+Coin credits run in transactions, so the mongod must be a replica set
+(mongod --replSet rs0, then rs.initiate() once).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+parser = argparse.ArgumentParser(description="Offline load simulation for bot.py")
+parser.add_argument("--users", type=int, default=1000, help="synthetic users to drive through the flow")
+parser.add_argument("--concurrency", type=int, default=200, help="users in flight at once")
+parser.add_argument("--messages", type=int, default=5, help="chat messages each matched user sends")
+parser.add_argument("--api-latency", type=float, default=0.0, help="ms the fake Bot API sleeps per call")
+parser.add_argument("--real-limits", action="store_true", help="keep the 30 msg/s outbound limits (slow)")
+parser.add_argument("--db", default="chat_bench", help="database to run against; dropped unless --keep")
+parser.add_argument("--keep", action="store_true", help="don't drop the bench database first")
+parser.add_argument("--top", type=int, default=0, help="show the N largest allocation sites")
+parser.add_argument("--drafts", type=int, default=100_000, help="half-finished registrations for the draft memory check (0 skips)")
+parser.add_argument("--referral-flood", type=int, default=200, help="concurrent duplicate /start ref_ updates to check (0 skips)")
+parser.add_argument("--no-rate-check", action="store_true", help="skip the outbound rate limiter check (takes ~5s)")
+parser.add_argument("--timer-pairs", type=int, default=2000, help="live sessions for the timer wheel vs. JobQueue comparison (0 skips)")
+parser.add_argument("--match-sim", type=int, default=10_000, help="searchers already waiting in the matchmaking simulation (0 skips)")
+parser.add_argument("--workers", default="", help="comma-separated WORKERS counts to sweep, e.g. 1,2,4 (runs instead of the single-process bench)")
+parser.add_argument("--pair-stress", type=int, default=2000, help="concurrent pair/unpair operations for the orphaned-session check (0 skips)")
+args = parser.parse_args()
+
+# bot.py reads its configuration at import time
+os.environ.setdefault("TOKEN", "123456:bench")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_TLS", "false")
+os.environ["DB_NAME"] = args.db
+os.environ["METRICS_PORT"] = "0"
+# Set by worker_sweep() for the processes it spawns
+os.environ["WORKERS"] = os.environ.get("BENCH_WORKERS", "1")
+
+from pymongo import monitoring
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# Must be registered before bot.py creates its client
+db_ops = CommandCounter()
+monitoring.register(db_ops)
+
+import bot
+import structures
+from telegram import Update
+from telegram.ext import Application, ConversationHandler, ExtBot
+from telegram.request import BaseRequest
+
+if args.db == "dating_bot_main_stable": raise SystemExit("Refusing to run against the production database")
+
+# --- FAKE BOT API ---
+
+class FakeBotAPI(BaseRequest):
+    """Answers every Bot API method locally with a minimal valid result"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+        self.floods = {}  # chat_id -> [retry_after, sends left to refuse]
+        self.sent = None  # set to a list to record (time, method, params) of every answered call
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def message(self, chat_id, **fields):
+        chat = {"id": chat_id, "type": "private" if int(chat_id) > 0 else "supergroup"}
+        return {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat, **fields}
+
+    def result(self, method, params):
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": params["user_id"], "is_bot": False, "first_name": "User"}}
+        if method == "getChat":
+            return {"id": chat_id, "type": "channel", "title": "Updates", "invite_link": "https://t.me/+bench",
+                    "accent_color_id": 0, "max_reaction_count": 11}
+        if method == "copyMessage": return {"message_id": next(self.message_ids)}
+        if method == "copyMessages": return [{"message_id": next(self.message_ids)} for _ in params["message_ids"]]
+        if method in ("sendMessage", "editMessageText"): return self.message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            return self.message(chat_id, photo=[{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}])
+        if method == "editMessageCaption": return self.message(chat_id, caption=params.get("caption", ""))
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        if self.latency: await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        flood = self.floods.get(params.get("chat_id"))
+        if flood and flood[1]:
+            flood[1] -= 1
+            return 429, json.dumps({"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {flood[0]}",
+                                    "parameters": {"retry_after": flood[0]}}).encode()
+        if self.sent is not None: self.sent.append((time.monotonic(), name, params))
+        return 200, json.dumps({"ok": True, "result": self.result(name, params)}).encode()
+
+    def flood(self, chat_id, retry_after, times=1):
+        """Refuses the next `times` calls for chat_id with a 429, like Telegram's flood control"""
+        self.floods[chat_id] = [retry_after, times]
+
+# --- SYNTHETIC USERS ---
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+def make_update(app, user_id, text=None, photo=False):
+    message = {
+        "message_id": next(message_ids), "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+    }
+    if photo: message["photo"] = [{"file_id": f"photo{user_id}", "file_unique_id": f"p{user_id}", "width": 1, "height": 1}]
+    else:
+        message["text"] = text
+        if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": next(update_ids), "message": message}, app.bot)
+
+class Driver:
+    def __init__(self, app):
+        self.app = app
+        self.latencies = defaultdict(list)  # step -> seconds per update
+        self.updates = 0
+
+    async def send(self, step, user_id, text=None, photo=False):
+        update = make_update(self.app, user_id, text, photo)
+        start = time.perf_counter()
+        # The same path the application's fetcher uses, including the per-user processor
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        self.latencies[step].append(time.perf_counter() - start)
+        self.updates += 1
+
+    async def run_user(self, user_id, index):
+        await self.send("start", user_id, "/start")
+        await self.send("register", user_id, f"User {index}")
+        await self.send("register", user_id, str(18 + index % 30))
+        await self.send("register", user_id, "Male" if index % 2 else "Female")
+        await self.send("register", user_id, "Just benchmarking")
+        await self.send("register", user_id, photo=True)
+        await self.send("search", user_id, "/search")
+        await self.chat(user_id)
+        await self.send("next", user_id, "/next")
+        await self.chat(user_id)
+        await self.send("stop", user_id, "/stop")
+
+    async def chat(self, user_id):
+        if user_id not in bot.chat_sessions: return
+        for n in range(args.messages): await self.send("chat", user_id, f"hello {n}")
+
+failed_checks = []  # the run exits non-zero if any check failed
+
+def verdict(name, ok, detail=""):
+    if ok: return "OK"
+    failed_checks.append(name)
+    return f"FAIL: {detail}" if detail else "FAIL"
+
+async def query_plan_check():
+    """The hot queries must be served by the indexes setup_indexes() creates"""
+    scans = await bot.verify_query_plans()
+    print(f"\nQuery plans: {'COLLSCAN in ' + ', '.join(scans) if scans else 'no collection scans'}  [{verdict('query plans', not scans)}]")
+
+async def referral_flood(app, referrer_id, copies):
+    """Fires duplicate referral /starts at once, skipping the per-user processor (as separate workers would).
+    Every other one names a referrer that doesn't exist; the real referrer must be credited exactly once."""
+    referee_id, unknown_id = 99_000_000, 99_000_001
+    before = (await bot.users_collection.find_one({"_id": referrer_id}))["coins"]
+    updates = [make_update(app, referee_id, f"/start ref_{unknown_id if n % 2 else referrer_id}") for n in range(copies)]
+    await asyncio.gather(*(app.process_update(update) for update in updates))
+    after = (await bot.users_collection.find_one({"_id": referrer_id}))["coins"]
+    credits = (after - before) // bot.REFERRAL_BONUS
+    ledger = await bot.coin_transactions_collection.count_documents({"_id": f"referral:{referee_id}", "user_id": referrer_id})
+    status = verdict("referral flood", credits == 1 and ledger == 1)
+    print(f"\nReferral flood: {copies} concurrent /start -> credited {credits}x, {ledger} ledger entry  [{status}]")
+
+async def pair_stress(operations, population=100):
+    """Races set_chat_pair/clear_chat_pair over a small pool of searchers, then checks that every
+    chatting user's partner points back, every searcher is still in the pool and the session map matches Mongo"""
+    ids = list(range(30_000_000, 30_000_000 + population))
+    await bot.users_collection.insert_many([
+        {"_id": user_id, "name": f"Stress {user_id}", "age": 25, "gender": "Male", "status": "searching", "chat_partner": None}
+        for user_id in ids])
+    for user_id in ids: bot.matchmaker.enqueue({"_id": user_id, "age": 25, "gender": "Male"})
+    rng = random.Random(4)
+    def operation():
+        a, b = rng.sample(ids, 2)
+        return bot.clear_chat_pair(a) if rng.random() < 0.3 else bot.set_chat_pair(a, b)
+    await asyncio.gather(*(operation() for _ in range(operations)))
+    docs = {user["_id"]: user async for user in bot.users_collection.find({"_id": {"$in": ids}})}
+    half_pairs = sum(1 for user in docs.values() if user["status"] == "chatting"
+                     and docs.get(user["chat_partner"], {}).get("chat_partner") != user["_id"])
+    unqueued = sum(1 for user in docs.values() if user["status"] == "searching" and user["_id"] not in bot.matchmaker.waiting)
+    stale_sessions = sum(1 for user in docs.values()
+                         if bot.chat_sessions.get(user["_id"]) != (user["chat_partner"] if user["status"] == "chatting" else None))
+    chatting = sum(1 for user in docs.values() if user["status"] == "chatting")
+    status = verdict("pair stress", not (half_pairs or unqueued or stale_sessions))
+    print(f"\nPair stress: {operations} concurrent pair/unpair over {population} users -> {chatting} chatting, "
+          f"{half_pairs} half-paired, {unqueued} searchers missing from the pool, {stale_sessions} stale sessions  [{status}]")
+
+async def timer_comparison(pairs, messages=2000):
+    """Per-message cost of restarting the idle timer with `pairs` sessions live: TimerWheel.touch
+    vs. the JobQueue get_jobs_by_name/schedule_removal/run_once reset it replaced"""
+    rng = random.Random(5)
+    traffic = [(2 * pair, 2 * pair + 1) if rng.random() < 0.5 else (2 * pair + 1, 2 * pair) for pair in (rng.randrange(pairs) for _ in range(messages))]
+
+    wheel = structures.TimerWheel(bot.INACTIVITY_TIMEOUT)
+    for pair in range(pairs): wheel.touch(bot.session_key(2 * pair, 2 * pair + 1))
+    started = time.perf_counter()
+    for user_id, partner_id in traffic: wheel.touch(bot.session_key(user_id, partner_id))
+    wheel_cost = (time.perf_counter() - started) / messages
+
+    async def timed_out(context):
+        pass
+
+    # APScheduler logs every added job at INFO; leave that out of the comparison
+    scheduler_log = logging.getLogger("apscheduler")
+    level = scheduler_log.level
+    scheduler_log.setLevel(logging.WARNING)
+    app = Application.builder().token(os.environ["TOKEN"]).request(FakeBotAPI()).build()
+    async with app:
+        job_queue = app.job_queue
+        await job_queue.start()
+
+        def reset(user_id, partner_id):
+            # reset_inactivity_timer before the wheel
+            for uid in (user_id, partner_id):
+                for job in job_queue.get_jobs_by_name(f"inactivity_{uid}"): job.schedule_removal()
+            job_queue.run_once(timed_out, bot.INACTIVITY_TIMEOUT, data=user_id, name=f"inactivity_{user_id}")
+
+        for pair in range(pairs): reset(2 * pair, 2 * pair + 1)
+        started = time.perf_counter()
+        for user_id, partner_id in traffic: reset(user_id, partner_id)
+        job_cost = (time.perf_counter() - started) / messages
+        await job_queue.stop(wait=False)
+    scheduler_log.setLevel(level)
+    print(f"\nInactivity timers: {pairs} live sessions, {messages} messages -> TimerWheel {wheel_cost * 1e6:.2f}µs/message, "
+          f"JobQueue {job_cost * 1e6:.0f}µs/message ({job_cost / wheel_cost:.0f}x)")
+
+def peak_count(times, window):
+    """Most calls that fall inside any `window` seconds"""
+    times, peak, first = sorted(times), 0, 0
+    for last, stamp in enumerate(times):
+        while stamp - times[first] >= window: first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+async def rate_limit_check():
+    """Sends through a fresh PriorityRateLimiter at the real limits against the fake Bot API:
+    lanes come out in priority order, the global and per-chat rates hold, and a 429 pauses every send"""
+    api = FakeBotAPI()
+    limiter = bot.PriorityRateLimiter()
+    failures = []
+    async with ExtBot(os.environ["TOKEN"], request=api, rate_limiter=limiter) as tg:
+        # Fresh limiter: a full global bucket adds only its burst to the first second
+        api.sent = []
+        await asyncio.gather(*(tg.send_message(39_000_000 + i, "fresh") for i in range(2 * bot.GLOBAL_SEND_RATE)))
+        fresh_peak = peak_count([stamp for stamp, _, _ in api.sent], 1.0)
+        if fresh_peak > bot.GLOBAL_SEND_RATE + bot.GLOBAL_SEND_BURST: failures.append(f"{fresh_peak} sends in 1s from a fresh limiter")
+
+        # Lanes: with the global bucket empty, 60 sends to different chats queue up and leave relay, notice, bulk
+        api.sent = []
+        limiter.global_bucket.tokens, limiter.global_bucket.updated = 0, time.monotonic()
+        lanes = [bot.PRIORITY_BULK, bot.PRIORITY_NOTICE, bot.PRIORITY_RELAY]
+        await asyncio.gather(*(tg.send_message(40_000_000 + i, str(lanes[i % 3]), rate_limit_args={"priority": lanes[i % 3]}) for i in range(60)))
+        order = [int(params["text"]) for _, _, params in api.sent]
+        if order != sorted(order): failures.append("lanes out of order")
+        global_peak = peak_count([stamp for stamp, _, _ in api.sent], 1.0)
+        if global_peak > bot.GLOBAL_SEND_RATE + 1: failures.append(f"{global_peak} sends in 1s globally")
+
+        # Per chat: the burst goes at once, the rest at CHAT_SEND_RATE
+        api.sent = []
+        await asyncio.gather(*(tg.send_message(40_001_000, "burst") for _ in range(bot.CHAT_SEND_BURST + 3)))
+        chat_peak = peak_count([stamp for stamp, _, _ in api.sent], 1.0)
+        if chat_peak > bot.CHAT_SEND_BURST + bot.CHAT_SEND_RATE: failures.append(f"{chat_peak} sends in 1s to one chat")
+
+        # RetryAfter: the refused send is retried after the pause, and a send to another chat waits it out too
+        api.sent, retried = [], limiter.retried
+        api.flood(40_002_000, 1)
+        started = time.monotonic()
+        async def bystander():
+            await asyncio.sleep(0.1)
+            await tg.send_message(40_002_001, "bystander")
+        await asyncio.gather(tg.send_message(40_002_000, "flooded"), bystander())
+        delivered = {params["chat_id"]: stamp - started for stamp, _, params in api.sent}
+        if limiter.retried != retried + 1 or delivered.get(40_002_000, 0) < 1.0: failures.append("429 not retried after retry_after")
+        if delivered.get(40_002_001, 0) < 1.0: failures.append("sends not paused by a 429")
+    print(f"\nRate limiter: lanes {''.join(map(str, order[:3]))}…{''.join(map(str, order[-3:]))}, peak {global_peak}/s global "
+          f"({fresh_peak}/s fresh, limit {bot.GLOBAL_SEND_RATE} + burst {bot.GLOBAL_SEND_BURST}), "
+          f"{chat_peak}/s per chat (burst {bot.CHAT_SEND_BURST} + {bot.CHAT_SEND_RATE}/s), 429 retried after {delivered.get(40_002_000, 0):.1f}s"
+          f"  [{verdict('rate limiter', not failures, ', '.join(failures))}]")
+
+class SimClock:
+    """Stands in for the time module inside structures.py so simulated searchers can wait for minutes instantly"""
+
+    def __init__(self):
+        self.now = 1_000.0
+
+    def monotonic(self):
+        return self.now
+
+def sim_searcher(rng, user_id):
+    # Skewed like most dating pools, so gender preferences build up a real backlog
+    user = {"_id": user_id, "gender": "Male" if rng.random() < 0.65 else "Female", "age": rng.randint(18, 50)}
+    if rng.random() < 0.6: user["pref_gender"] = "Female" if user["gender"] == "Male" else "Male"
+    if rng.random() < 0.3: user["pref_age"] = [max(18, user["age"] - 5), user["age"] + 5]
+    return user
+
+def match_simulation(waiting, arrival_rate=2000, duration=120):
+    """Matchmaking on a simulated clock: `waiting` searchers already in the pool, then arrivals at
+    arrival_rate/s with the sweep's widening and expiry every SEARCH_SWEEP_INTERVAL.
+    Reports match rate, time-to-match and the real cost of each match() call."""
+    rng = random.Random(12)
+    clock, real_time = SimClock(), structures.time
+    structures.time = clock  # only the matchmaker runs meanwhile, and it just reads time.monotonic()
+    try:
+        matchmaker = structures.Matchmaker()
+        started = {}  # user_id -> simulated enqueue time
+        waits, call_times = [], []
+        timed_out = 0
+        for offset in sorted((rng.uniform(0, bot.SEARCH_TIMEOUT) for _ in range(waiting)), reverse=True):
+            user = sim_searcher(rng, len(started))
+            started[user["_id"]] = clock.now - offset
+            matchmaker.enqueue(user, enqueued_at=started[user["_id"]])
+        pool_sizes = [len(matchmaker)]
+        next_sweep = clock.now + bot.SEARCH_SWEEP_INTERVAL
+        for _ in range(int(arrival_rate * duration)):
+            clock.now += 1 / arrival_rate
+            if clock.now >= next_sweep:
+                for a, b in matchmaker.rematch_widened(): waits += [clock.now - started[a], clock.now - started[b]]
+                timed_out += len(matchmaker.expire(bot.SEARCH_TIMEOUT))
+                pool_sizes.append(len(matchmaker))
+                next_sweep += bot.SEARCH_SWEEP_INTERVAL
+            user = sim_searcher(rng, len(started))
+            started[user["_id"]] = clock.now
+            call_started = time.perf_counter()
+            partner_id = matchmaker.match(user)
+            call_times.append(time.perf_counter() - call_started)
+            if partner_id is None: matchmaker.enqueue(user)
+            else: waits += [0.0, clock.now - started[partner_id]]
+    finally: structures.time = real_time
+    waits.sort()
+    call_times.sort()
+    matched = len(waits)
+    print(f"\nMatchmaking: {waiting} waiting + {len(call_times)} arrivals over {duration}s simulated, pool {min(pool_sizes)}-{max(pool_sizes)}")
+    print(f"  {matched / max(1, matched + timed_out):.1%} matched ({matched} matched, {timed_out} timed out, {len(matchmaker)} still waiting)")
+    print(f"  time-to-match p50 {percentile(waits, 0.5):.1f}s, p90 {percentile(waits, 0.9):.1f}s, p99 {percentile(waits, 0.99):.1f}s")
+    print(f"  match() {sum(call_times) / len(call_times) * 1e6:.1f}µs avg, p99 {percentile(call_times, 0.99) * 1e6:.1f}µs")
+
+def draft_memory(count, app):
+    """Memory held by `count` half-finished registrations: slotted drafts in the TTL store
+    vs. the per-user user_data dicts they replaced, plus the ConversationHandler's own per-user state,
+    which only conversation_timeout ever clears for users who walk away"""
+    names = [f"User {i}" for i in range(count)]  # shared by both, so only the containers are measured
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    store = structures.DraftStore(count, bot.DRAFT_TTL, persist=False)
+    for i, name in enumerate(names): store.update(i, name=name, age=25, gender="Male")
+    slotted = tracemalloc.get_traced_memory()[0] - base
+    del store
+    base = tracemalloc.get_traced_memory()[0]
+    user_data = defaultdict(dict)
+    for i, name in enumerate(names): user_data[i].update(name=name, age=25, gender="Male")
+    dicts = tracemalloc.get_traced_memory()[0] - base
+    del user_data
+    conversations = [handler for handler in app.handlers[0] if isinstance(handler, ConversationHandler)]
+    registration = next(handler for handler in conversations if handler.name == "registration")
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(count): registration._conversations[(40_000_000 + i, 40_000_000 + i)] = bot.REG_AGE
+    handler_state = tracemalloc.get_traced_memory()[0] - base
+    registration._conversations.clear()
+    tracemalloc.stop()
+    timeouts = {handler.name: handler.conversation_timeout for handler in conversations}
+    ok = all(timeout == bot.DRAFT_TTL for timeout in timeouts.values())
+    print(f"\nDrafts: {count} half-finished registrations -> {slotted / 1024 / 1024:.1f} MiB slotted ({slotted / count:.0f} B each, incl. TTL bookkeeping)"
+          f" vs {dicts / 1024 / 1024:.1f} MiB as user_data dicts ({dicts / count:.0f} B each)"
+          f"; ConversationHandler state {handler_state / 1024 / 1024:.1f} MiB ({handler_state / count:.0f} B each)"
+          f"  [{verdict('conversation timeouts', ok, f'timeouts {timeouts}, expected {bot.DRAFT_TTL}s')}]")
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+# --- RUN ---
+
+def lift_limits():
+    if not args.real_limits:
+        # The outbound limits would turn this into a 30 msg/s benchmark
+        bot.CHAT_SEND_RATE = bot.CHAT_SEND_BURST = 1e9
+        bot.rate_limiter.global_bucket = bot.TokenBucket(1e9, 1e9)
+
+async def run():
+    if args.match_sim: match_simulation(args.match_sim)
+    if args.timer_pairs: await timer_comparison(args.timer_pairs)
+    if not args.no_rate_check: await rate_limit_check()  # before lift_limits()
+    api = FakeBotAPI(args.api_latency / 1000)
+    lift_limits()
+    app = bot.build_application(with_updater=False, request=api)
+    if args.drafts: draft_memory(args.drafts, app)
+    if not args.keep: await bot.client.drop_database(bot.DB_NAME)
+    started = time.perf_counter()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    startup = time.perf_counter() - started
+    await query_plan_check()
+
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    db_ops.commands.clear()
+    api.calls.clear()
+
+    driver = Driver(app)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async def user_task(index):
+        async with semaphore: await driver.run_user(10_000_000 + index, index)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_task(i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    mem_after, mem_peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot() if args.top else None
+    if args.referral_flood and args.users: await referral_flood(app, 10_000_000, args.referral_flood)
+    if args.pair_stress: await pair_stress(args.pair_stress)
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.post_shutdown(app)  # flushes buffered writes so they are counted
+    await app.shutdown()
+    tracemalloc.stop()
+    report(driver, startup, elapsed, mem_before, mem_after, mem_peak, api, snapshot)
+
+def report(driver, startup, elapsed, mem_before, mem_after, mem_peak, api, snapshot):
+    updates = driver.updates or 1
+    print(f"\n{args.users} users, {driver.updates} updates in {elapsed:.2f}s ({driver.updates / elapsed:.0f} updates/s), startup {startup:.2f}s")
+    print(f"\n{'step':<10}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    everything = []
+    for step in ("start", "register", "search", "chat", "next", "stop"):
+        values = sorted(driver.latencies.get(step, ()))
+        everything += values
+        if values: print(f"{step:<10}{len(values):>8}{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}{values[-1] * 1000:>10.2f}")
+    everything.sort()
+    print(f"{'all':<10}{len(everything):>8}{percentile(everything, 0.5) * 1000:>10.2f}{percentile(everything, 0.99) * 1000:>10.2f}")
+
+    total_ops = sum(db_ops.commands.values())
+    print(f"\nMongo: {total_ops} commands, {total_ops / updates:.2f} per update")
+    for name, count in db_ops.commands.most_common(): print(f"  {name:<18}{count:>8}{count / updates:>8.2f}/update")
+    total_calls = sum(api.calls.values())
+    print(f"\nBot API: {total_calls} calls, {total_calls / updates:.2f} per update")
+    for name, count in api.calls.most_common(): print(f"  {name:<18}{count:>8}{count / updates:>8.2f}/update")
+
+    growth = mem_after - mem_before
+    print(f"\nMemory: +{growth / 1024:.0f} KiB over the run ({growth / args.users:.0f} B/user), peak {mem_peak / 1024:.0f} KiB")
+    print(f"  user_cache {len(bot.user_cache)}, profile_cards {len(bot.profile_cards)}, match_cards {len(bot.match_cards)}, relayed_messages {len(bot.relayed_messages)}")
+    if snapshot:
+        print(f"\nTop {args.top} allocation sites:")
+        for stat in snapshot.statistics("lineno")[:args.top]: print(f"  {stat}")
+
+# --- WORKER SWEEP ---
+
+async def drive_shard(shard, workers, inbox, ready, go):
+    """One worker of a sharded run: the users it owns go through its own application,
+    while invalidations from the other workers arrive on its inbox as they do in production"""
+    lift_limits()
+    app = bot.build_application(with_updater=False, request=FakeBotAPI(args.api_latency / 1000))
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.post_init(app)
+        await app.start()
+
+        async def listen():
+            while True:
+                kind, payload = await loop.run_in_executor(None, inbox.get)
+                if kind == "stop": return
+                bot.handle_shard_message(kind, payload)
+
+        listener = asyncio.create_task(listen())
+        driver = Driver(app)
+        semaphore = asyncio.Semaphore(max(1, args.concurrency // workers))
+        async def user_task(index):
+            async with semaphore: await driver.run_user(10_000_000 + index, index)
+
+        ready.put(shard)
+        await loop.run_in_executor(None, go.wait)
+        started = time.perf_counter()
+        await asyncio.gather(*(user_task(i) for i in range(args.users) if bot.shard_for(10_000_000 + i) == shard))
+        elapsed = time.perf_counter() - started
+        inbox.put(("stop", None))
+        await listener
+        await app.stop()
+        await app.post_stop(app)
+        await app.post_shutdown(app)
+    return driver.updates, elapsed
+
+def shard_worker(shard, workers, inboxes, ready, go, results):
+    bot.SHARD, bot.shard_inboxes = shard, inboxes
+    results.put(asyncio.run(drive_shard(shard, workers, inboxes[shard], ready, go)))
+
+async def drop_bench_database():
+    # A client per call, since every asyncio.run() is a new event loop
+    client = bot.connect_mongo()
+    await client.drop_database(bot.DB_NAME)
+    await client.close()
+    bot.client = None
+
+def worker_sweep(counts):
+    """Runs the same user flow with WORKERS=1, 2, ... processes and reports how throughput scales"""
+    # spawn, like run_sharded(): every worker gets its own Mongo client and event loop
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'workers':<10}{'updates':>10}{'seconds':>10}{'updates/s':>12}{'speedup':>10}")
+    baseline = None
+    for workers in counts:
+        if not args.keep: asyncio.run(drop_bench_database())
+        os.environ["BENCH_WORKERS"] = str(workers)
+        inboxes = [ctx.Queue() for _ in range(workers)]
+        ready, results, go = ctx.Queue(), ctx.Queue(), ctx.Event()
+        processes = [ctx.Process(target=shard_worker, args=(shard, workers, inboxes, ready, go, results)) for shard in range(workers)]
+        for process in processes: process.start()
+        for _ in processes: ready.get()
+        go.set()  # every worker has finished startup, so only the user flow is timed
+        outcomes = [results.get() for _ in processes]
+        for process in processes: process.join()
+        updates = sum(count for count, _ in outcomes)
+        elapsed = max(seconds for _, seconds in outcomes)
+        throughput = updates / elapsed if elapsed else 0.0
+        baseline = baseline or throughput
+        print(f"{workers:<10}{updates:>10}{elapsed:>10.2f}{throughput:>12.0f}{throughput / baseline:>9.2f}x")
+
+if __name__ == "__main__":
+    if args.workers: worker_sweep([int(count) for count in args.workers.split(",")])
+    else: asyncio.run(run())
+    if failed_checks: raise SystemExit(f"Failed checks: {', '.join(failed_checks)}")
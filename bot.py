@@ -1,11 +1,22 @@
 
-import logging
 import time
+IMPORT_STARTED = time.perf_counter()
+import logging
 import datetime
 import asyncio
 import os
 import html
-from pymongo import MongoClient
+import bisect
+import functools
+import multiprocessing
+import heapq
+import itertools
+import contextlib
+import signal
+from collections import Counter, defaultdict
+from pymongo import AsyncMongoClient, UpdateOne, DeleteOne, IndexModel, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from structures import Matchmaker, TTLCache, TimerWheel, Draft, DraftStore
 
 # --- HEROKU CONFIGURATION ---
 TOKEN = os.getenv("TOKEN")
@@ -13,9 +24,23 @@ MONGO_URI = os.getenv("MONGO_URI")
 OWNER_ID = int(os.getenv("OWNER_ID", "6804892450"))
 LOG_GROUP_ID = int(os.getenv("LOG_GROUP_ID", "-1002918236314"))
 UPDATE_CHANNEL_ID = int(os.getenv("UPDATE_CHANNEL_ID", "-1003491668063"))
-DB_NAME = "dating_bot_main_stable"
-
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, ChatMember
+DB_NAME = os.getenv("DB_NAME", "dating_bot_main_stable")
+MONGO_TLS = os.getenv("MONGO_TLS", "true").lower() != "false"  # false for a local mongod (e.g. bench.py)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))  # per process
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))  # opened during warm-up and kept open
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", "5000"))  # server selection / connect / pool wait
+MONGO_CONNECT_ATTEMPTS = 5
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # e.g. https://<app>.herokuapp.com; polling when unset
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8443"))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # serves /metrics when set (worker N uses port + N)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # 0.0.0.0 only behind something that restricts scrapers
+WORKERS = int(os.getenv("WORKERS", "1"))  # >1 partitions users across worker processes
+
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, ChatMember
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
@@ -25,7 +50,12 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput,
 )
+from telegram.error import RetryAfter, Forbidden
 
 # --- LOGGING ---
 logging.basicConfig(
@@ -33,33 +63,471 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- STARTUP TIMINGS ---
+
+startup_phases = {}  # phase -> seconds, in the order they finished
+
+@contextlib.contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try: yield
+    finally: startup_phases[name] = time.perf_counter() - started
+
+async def timed_phase(name, coro):
+    with startup_phase(name): return await coro
+
 # --- MONGODB CONNECTION ---
-try:
-    client = MongoClient(MONGO_URI, tls=True, tlsAllowInvalidCertificates=True)
-    db = client[DB_NAME] 
+# Built by connect_mongo() from build_application, so importing this module does no I/O
+# (and the multi-worker router, which never touches Mongo, never opens a pool)
+client = db = None
+users_collection = blocks_collection = meta_collection = broadcasts_collection = coin_transactions_collection = None
+drafts_collection = conversations_collection = None
+
+def connect_mongo():
+    global client, db, users_collection, blocks_collection, meta_collection, broadcasts_collection, coin_transactions_collection
+    global drafts_collection, conversations_collection
+    if client is not None: return client
+    client = AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=min(MONGO_MIN_POOL_SIZE, MONGO_MAX_POOL_SIZE),
+        serverSelectionTimeoutMS=MONGO_TIMEOUT_MS, connectTimeoutMS=MONGO_TIMEOUT_MS, waitQueueTimeoutMS=MONGO_TIMEOUT_MS,
+        **({"tls": True, "tlsAllowInvalidCertificates": True} if MONGO_TLS else {})
+    )
+    db = client[DB_NAME]
     users_collection = db['users']
-    print(f"✅ Connected to MongoDB! Database: {DB_NAME}")
-except Exception as e:
-    print(f"❌ Connection Error: {e}")
-    exit()
+    blocks_collection = db['blocks']  # one {blocker, blocked} document per block
+    meta_collection = db['meta']  # one-off migration markers
+    broadcasts_collection = db['broadcasts']  # owner broadcasts and their delivery checkpoints
+    coin_transactions_collection = db['coin_transactions']  # append-only ledger, _id is the idempotency key
+    drafts_collection = db['drafts']  # unfinished registration/edit answers, by user id
+    conversations_collection = db['conversations']  # ConversationHandler states
+    return client
+
+async def warm_up_mongo():
+    """Opens the pool's first connections concurrently, retrying with backoff before giving up"""
+    for attempt in range(1, MONGO_CONNECT_ATTEMPTS + 1):
+        try:
+            await asyncio.gather(*(client.admin.command("ping") for _ in range(max(1, min(MONGO_MIN_POOL_SIZE, MONGO_MAX_POOL_SIZE)))))
+            logger.info(f"✅ Connected to MongoDB! Database: {DB_NAME}")
+            return
+        except Exception as e:
+            if attempt == MONGO_CONNECT_ATTEMPTS:
+                logger.error(f"❌ Connection Error: {e}")
+                raise
+            logger.warning(f"MongoDB not reachable (attempt {attempt}): {e}")
+            await asyncio.sleep(min(2 ** attempt, 10))
+
+# --- METRICS ---
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Minimal Prometheus-style registry: labelled counters and histograms, plus gauges read on scrape"""
+
+    def __init__(self):
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> zero-arg callable
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None: histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    @staticmethod
+    def _labels(labels, **extra):
+        pairs = list(labels) + list(extra.items())
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, read in sorted(self.gauges.items()):
+            try: lines.append(f"{name} {read()}")
+            except Exception as e: logger.debug(f"Gauge {name} failed: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed(metric, **labels):
+    """Decorator: records an async function's latency (and errors) under metric"""
+    def decorator(func):
+        name = labels or {"handler" if metric.startswith("handler") else "helper": func.__name__}
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try: return await func(*args, **kwargs)
+            except Exception as e:
+                metrics.inc(f"{metric}_errors_total", error=type(e).__name__, **name)
+                raise
+            finally: metrics.observe(f"{metric}_seconds", time.perf_counter() - start, **name)
+        return wrapper
+    return decorator
+
+timed_handler = timed("handler")
+timed_db = timed("mongo")
+
+async def serve_metrics(reader, writer):
+    """Tiny HTTP responder for Prometheus scrapes (any path returns the metrics)"""
+    try:
+        # Bounded, so a silent client can't hold up wait_closed() at shutdown
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        body = metrics.render().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+    except Exception: pass
+    finally: writer.close()
+
+# --- MATCHMAKING ---
+
+SEARCH_TIMEOUT = 60
+SEARCH_SWEEP_INTERVAL = 5
+
+matchmaker = Matchmaker()
+
+# --- CACHE ---
+
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+block_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)  # user_id -> set of ids they blocked
+
+# --- TEMPLATES ---
+# Markups are immutable, so the static ones are built once and shared by every send
+
+FIND_PARTNER_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("💬 Find New Partner", callback_data="search")]])
+RETRY_SEARCH_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Try Again", callback_data="search")]])
+PROFILE_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("💬 Start Chatting", callback_data="search")], [InlineKeyboardButton("✏️ Edit Profile", callback_data="edit")]])
+MATCH_CONTROLS = (InlineKeyboardButton("➡️ Next", callback_data="next"), InlineKeyboardButton("🛑 Stop", callback_data="stop"))
+GENDER_KEYBOARD = ReplyKeyboardMarkup([["Male", "Female"]], one_time_keyboard=True, resize_keyboard=True)
+EDIT_KEYBOARD = ReplyKeyboardMarkup([["Name", "Age"], ["Gender", "Bio"], ["Photo", "Cancel"]], one_time_keyboard=True, resize_keyboard=True)
+
+SEARCH_TIMEOUT_TEXT = "💤 **Search timed out.**\nNo active partners found right now."
+INACTIVITY_TEXT = "⏳ **Chat ended due to inactivity.**\n(5 minutes with no messages)\n\nType /search to find a new partner."
+COMMANDS_TEXT = (
+    "📜 **COMMANDS LIST:**\n"
+    "🔎 /search - Find Random Partner\n"
+    "💌 /chat `[ID]` - Direct Request\n"
+    "🛑 /stop - End Current Chat\n"
+    "➡️ /next - Skip Partner\n"
+    "🎯 /prefs - Partner Preferences\n"
+    "🚫 /block - Block User\n"
+    "⚠️ /report - Report Partner\n"
+    "💰 /balance - Check Coins\n"
+    "🎁 /referral - Invite & Earn\n\n"
+    "━━━━━━━━━━━━━━━━━━\n"
+    "🚀 **Ready to chat?**\n"
+    "Click the button below to find a partner!"
+)
+
+# Rendered per user and dropped by forget_cards whenever a field they show changes
+profile_cards = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)  # user_id -> caption
+match_cards = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)  # user_id -> (text, markup) shown to their partners
+
+def forget_cards(user_id):
+    profile_cards.pop(int(user_id))
+    match_cards.pop(int(user_id))
+
+def profile_card(user):
+    caption = profile_cards.get(user["_id"])
+    if caption is None:
+        caption = (
+            f"💎 **YOUR PROFILE** 💎\n\n"
+            f"👤 **Name:** {user.get('name')}\n"
+            f"🎂 **Age:** {user.get('age')}\n"
+            f"⚧ **Gender:** {user.get('gender')}\n"
+            f"💰 **Coins:** `{user.get('coins', 0)}`\n"
+            f"📝 **Bio:** {user.get('bio')}\n\n" + COMMANDS_TEXT
+        )
+        profile_cards.set(user["_id"], caption)
+    return caption
+
+def match_card(user):
+    """What a new partner sees about this user"""
+    card = match_cards.get(user["_id"])
+    if card is None:
+        user_id = user["_id"]
+        text = f"🎉 **PARTNER FOUND!** 🎉\n\n👤 **Name:** {user.get('name')}, {user.get('age')}\n⚧ **Gender:** {user.get('gender')}\n📝 **Bio:** {user.get('bio')}\n\n💬 **Say 'Hi'!**"
+        markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("👀 View Photo", callback_data=f"view_{user_id}")],
+            MATCH_CONTROLS,
+            [InlineKeyboardButton("🚫 Block User", callback_data=f"block_match_{user_id}")]
+        ])
+        card = (text, markup)
+        match_cards.set(user_id, card)
+    return card
+
+# --- INACTIVITY TRACKING ---
+
+INACTIVITY_TIMEOUT = 300  # 5 minutes
+INACTIVITY_SWEEP_INTERVAL = 5
+
+inactivity = TimerWheel(INACTIVITY_TIMEOUT)
+
+def session_key(user_id, partner_id):
+    return (min(int(user_id), int(partner_id)), max(int(user_id), int(partner_id)))
+
+chat_sessions = {}  # user_id -> partner_id for live chats, read on every relayed message
+
+def open_session(user_id, partner_id, deadline=None):
+    chat_sessions[int(user_id)], chat_sessions[int(partner_id)] = int(partner_id), int(user_id)
+    inactivity.touch(session_key(user_id, partner_id), deadline)
+
+def close_session(user_id, partner_id):
+    for a, b in [(int(user_id), int(partner_id)), (int(partner_id), int(user_id))]:
+        if chat_sessions.get(a) == b: del chat_sessions[a]
+    inactivity.discard(session_key(user_id, partner_id))
+    forwarded_touches.pop(session_key(user_id, partner_id), None)
+
+# --- SHARDING ---
+
+# Set in each worker process by run_worker(); a single process owns every user
+SHARDED = WORKERS > 1
+SHARD = 0
+shard_inboxes = []
+CROSS_SHARD_TOUCH_INTERVAL = 30
+SHUTDOWN_GRACE = 25  # seconds the router waits for workers to flush; Heroku kills the dyno 30s after SIGTERM
+forwarded_touches = {}  # session key -> last time the partner's worker was told
+
+def shard_for(user_id):
+    return int(user_id) % WORKERS
+
+def publish(shard, kind, payload):
+    shard_inboxes[shard].put_nowait((kind, payload))
+
+def broadcast_invalidation(user_id, kind="invalidate"):
+    """Tells every other worker to drop its cached copy of a user we just wrote"""
+    if not SHARDED: return
+    for shard in range(WORKERS):
+        if shard != SHARD: publish(shard, kind, int(user_id))
+
+def invalidate_user(user_id):
+    user_cache.pop(int(user_id))
+    broadcast_invalidation(user_id)
+
+def patch_cached_user(user_id, fields):
+    """Applies a write to the cached document (if any) so readers never see stale data"""
+    user_cache.written(int(user_id))
+    user = user_cache.peek(int(user_id))
+    if user is not None: user_cache.set(int(user_id), {**user, **fields})
+    broadcast_invalidation(user_id)
+
+# --- ACTIVITY ---
+
+ACTIVITY_FLUSH_INTERVAL = 10  # seconds; last_active in Mongo lags by at most this much
+
+class ActivityBuffer:
+    """Last-seen timestamps kept in memory and written in one unordered bulk_write per flush"""
+
+    def __init__(self):
+        self.pending = {}  # user_id -> datetime
+
+    def __len__(self):
+        return len(self.pending)
+
+    def touch(self, user_id):
+        self.pending[int(user_id)] = datetime.datetime.now()
+
+    async def flush(self):
+        if not self.pending: return 0
+        pending, self.pending = self.pending, {}
+        try:
+            # Any activity also revives users a broadcast marked inactive
+            await users_collection.bulk_write([UpdateOne({"_id": user_id}, {"$set": {"last_active": seen}, "$unset": {"inactive": ""}}) for user_id, seen in pending.items()], ordered=False)
+        except Exception:
+            # Keep whatever is newer so the next flush retries it
+            for user_id, seen in pending.items(): self.pending.setdefault(user_id, seen)
+            raise
+        return len(pending)
+
+activity = ActivityBuffer()
+
+async def activity_flush_task(context):
+    try: await activity.flush()
+    except Exception as e: logger.warning(f"Activity flush failed: {e}")
+
+async def on_shutdown(app):
+    await activity.flush()
+
+# --- LOG SHIPPING ---
+
+LOG_QUEUE_SIZE = 1000  # events waiting to be shipped; past this new ones are dropped and counted
+LOG_FLUSH_INTERVAL = 5  # seconds between combined log-group messages
+LOG_MESSAGE_LIMIT = 4096  # Telegram's text limit
+
+class LogShipper:
+    """Session events for LOG_GROUP_ID. Handlers only enqueue; a job sends them in combined messages."""
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize)
+        self.shipped = self.dropped = 0
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def emit(self, text):
+        try: self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.inc("log_events_dropped_total")
+
+    def _batches(self):
+        """Drains what is queued now into message-sized groups"""
+        batch, size = [], 0
+        for _ in range(self.queue.qsize()):
+            text = self.queue.get_nowait()
+            if batch and size + len(text) + 2 > LOG_MESSAGE_LIMIT:
+                yield batch
+                batch, size = [], 0
+            batch.append(text)
+            size += len(text) + 2
+        if batch: yield batch
+
+    async def flush(self, bot):
+        for batch in self._batches():
+            try: await bot.send_message(LOG_GROUP_ID, "\n\n".join(batch), parse_mode=ParseMode.HTML, rate_limit_args=BULK)
+            except Exception as e:
+                self.dropped += len(batch)
+                metrics.inc("log_events_dropped_total", len(batch))
+                logger.debug(f"Log shipping failed: {e}")
+            else: self.shipped += len(batch)
+
+log_shipper = LogShipper()
+
+async def log_flush_task(context):
+    await log_shipper.flush(context.bot)
+
+async def on_stop(app):
+    # First, so the flushes below are not stuck behind broadcast sends
+    await stop_broadcast(app)
+    # Before shutdown closes the bot's connection
+    await log_shipper.flush(app.bot)
+    server = app.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+# --- INDEXES ---
+
+# Case-insensitive match for usernames (strength 2 ignores case, not diacritics)
+USERNAME_COLLATION = {"locale": "en", "strength": 2}
+
+async def ensure_indexes():
+    await users_collection.create_indexes([
+        IndexModel([("status", ASCENDING), ("last_active", ASCENDING)], name="status_last_active"),
+        IndexModel([("username", ASCENDING)], name="username_ci", collation=USERNAME_COLLATION),
+        IndexModel([("search_started", ASCENDING)], name="searching_since", partialFilterExpression={"status": "searching"}),
+    ])
+    await blocks_collection.create_indexes([
+        IndexModel([("blocker", ASCENDING)], name="blocker"),
+        IndexModel([("blocked", ASCENDING)], name="blocked"),
+    ])
+    await coin_transactions_collection.create_indexes([
+        IndexModel([("user_id", ASCENDING), ("created", ASCENDING)], name="user_created"),
+    ])
+    # Abandoned flows age out of Mongo the same way they age out of memory
+    await drafts_collection.create_indexes([IndexModel([("updated", ASCENDING)], name="expire", expireAfterSeconds=DRAFT_TTL)])
+    await conversations_collection.create_indexes([
+        IndexModel([("updated", ASCENDING)], name="expire", expireAfterSeconds=DRAFT_TTL),
+        IndexModel([("name", ASCENDING), ("updated", ASCENDING)], name="name_updated"),
+    ])
+
+def _plan_stages(plan):
+    yield plan.get("stage")
+    for child in plan.get("inputStages", []) + [plan[k] for k in ("inputStage", "queryPlan") if k in plan]:
+        yield from _plan_stages(child)
+
+async def verify_query_plans():
+    """Returns the hot queries whose winning plan is a full collection scan.
+    Run by bench.py rather than on every startup, where it cost a round trip per query."""
+    checks = {
+        "status": users_collection.find({"status": "searching"}),
+        "username": users_collection.find({"username": "probe"}).collation(USERNAME_COLLATION),
+        "searching_since": users_collection.find({"status": "searching", "search_started": {"$lt": datetime.datetime.now()}}),
+        "idle_chatters": users_collection.find({"status": "chatting", "last_active": {"$not": {"$gte": datetime.datetime.now()}}, "_id": {"$gt": 0}}).sort("_id", ASCENDING),
+    }
+    scans = []
+    for name, cursor in checks.items():
+        plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(plan): scans.append(name)
+    return scans
+
+async def setup_indexes():
+    try: await ensure_indexes()
+    except Exception as e: logger.error(f"Index setup failed: {e}")
+
+async def run_migrations():
+    try:
+        migrated = await migrate_block_lists()
+        if migrated: logger.info(f"Moved block lists of {migrated} users into the blocks collection")
+    except Exception as e: logger.error(f"Block list migration failed: {e}")
+
+async def on_startup(app):
+    # Independent of each other, so they share the round trips
+    await asyncio.gather(timed_phase("indexes", setup_indexes()), timed_phase("migrations", run_migrations()))
+    with startup_phase("reconcile"):
+        try: await reconcile_sessions()
+        except Exception as e: logger.error(f"Session reconciliation failed: {e}")
+        if PERSIST_CONVERSATIONS:
+            try: await drafts.load()
+            except Exception as e: logger.error(f"Loading drafts failed: {e}")
+    if not SHARDED or SHARD == shard_for(OWNER_ID):
+        try: await resume_broadcast(app)
+        except Exception as e: logger.error(f"Resuming broadcast failed: {e}")
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT + SHARD)
+    startup_phases["total"] = time.perf_counter() - IMPORT_STARTED
+    logger.info("Startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_phases.items()))
 
 # --- DATABASE FUNCTIONS ---
 
-def get_user(user_id):
-    return users_collection.find_one({"_id": int(user_id)})
+@timed_db
+async def find_user(user_id):
+    return await users_collection.find_one({"_id": user_id})
+
+async def get_user(user_id):
+    """Cached; only a miss reaches Mongo, so only misses show up in mongo_seconds (as find_user)"""
+    user_id = int(user_id)
+    user = user_cache.get(user_id)
+    if user is None: user = await user_cache.fill(user_id, lambda: find_user(user_id))
+    return user
 
-def get_user_by_query(query):
+@timed_db
+async def get_user_by_query(query):
     if str(query).isdigit():
-        return users_collection.find_one({"_id": int(query)})
+        return await users_collection.find_one({"_id": int(query)})
     clean_username = str(query).lstrip('@')
-    return users_collection.find_one({"username": {"$regex": f"^{clean_username}$", "$options": "i"}})
+    return await users_collection.find_one({"username": clean_username}, collation=USERNAME_COLLATION)
 
-def add_user(user_id, name, age, gender, bio, photo_id, username):
-    existing = users_collection.find_one({"_id": int(user_id)})
-    coins = existing.get("coins", 0) if existing else 0
-    blocked = existing.get("blocked_users", []) if existing else []
-    
-    users_collection.update_one(
+@timed_db
+async def add_user(user_id, name, age, gender, bio, photo_id, username):
+    # Coins are only ever changed through credit_coins, so a re-registration leaves them alone
+    await users_collection.update_one(
         {"_id": int(user_id)},
         {
             "$set": {
@@ -68,138 +536,683 @@ def add_user(user_id, name, age, gender, bio, photo_id, username):
                 "status": "idle", "chat_partner": None,
                 "last_active": datetime.datetime.now()
             },
-            "$setOnInsert": {"coins": coins, "blocked_users": blocked}
+            "$setOnInsert": {"coins": 0}
         },
         upsert=True
     )
+    invalidate_user(user_id)
+    forget_cards(user_id)
 
-def add_coins(user_id, amount):
-    users_collection.update_one({"_id": int(user_id)}, {"$inc": {"coins": amount}})
+SIGNUP_BONUS, REFERRAL_BONUS = 50, 100
 
-def update_activity(user_id):
-    users_collection.update_one({"_id": int(user_id)}, {"$set": {"last_active": datetime.datetime.now()}})
+@timed_db
+async def credit_coins(user_id, amount, key, reason):
+    """Credits once per idempotency key (e.g. "referral:<referee>").
 
-def set_status(user_id, status):
-    users_collection.update_one({"_id": int(user_id)}, {"$set": {"status": status}})
+    The ledger insert is the dedupe gate: a duplicate key means the credit already
+    happened. It commits in one transaction with the $inc that returns the new balance,
+    so an unknown user never uses up a key and a crash can't keep a row without its credit.
+    Returns the new balance, or None if the key was already used or the user is unknown.
+    """
+    user_id = int(user_id)
 
-def set_chat_pair(user1_id, user2_id):
-    users_collection.update_one({"_id": int(user1_id)}, {"$set": {"status": "chatting", "chat_partner": int(user2_id)}})
-    users_collection.update_one({"_id": int(user2_id)}, {"$set": {"status": "chatting", "chat_partner": int(user1_id)}})
-
-def clear_chat_pair(user_id):
-    user = get_user(user_id)
-    if user and user.get("chat_partner"):
-        partner_id = user["chat_partner"]
-        users_collection.update_one({"_id": int(user_id)}, {"$set": {"status": "idle", "chat_partner": None}})
-        users_collection.update_one({"_id": int(partner_id)}, {"$set": {"status": "idle", "chat_partner": None}})
-        return partner_id
-    return None
+    async def apply(session):
+        await coin_transactions_collection.insert_one({"_id": key, "user_id": user_id, "amount": amount, "reason": reason, "created": datetime.datetime.now()}, session=session)
+        user = await users_collection.find_one_and_update({"_id": user_id}, {"$inc": {"coins": amount}}, projection={"coins": 1}, return_document=ReturnDocument.AFTER, session=session)
+        if user is None: await session.abort_transaction()
+        return user
 
-def block_user(user_id, target_id):
-    users_collection.update_one({"_id": int(user_id)}, {"$addToSet": {"blocked_users": int(target_id)}})
-
-def unblock_user(user_id, target_id):
-    users_collection.update_one({"_id": int(user_id)}, {"$pull": {"blocked_users": int(target_id)}})
+    # Transactions need a replica set; Atlas always is one, a local mongod needs --replSet
+    try:
+        async with client.start_session() as session: user = await session.with_transaction(apply)
+    except DuplicateKeyError: return None
+    if user is None: return None
+    patch_cached_user(user_id, {"coins": user["coins"]})
+    profile_cards.pop(user_id)
+    return user["coins"]
 
-def is_blocked(user_id, target_id):
-    target = users_collection.find_one({"_id": int(target_id)})
-    if target and "blocked_users" in target:
-        if int(user_id) in target["blocked_users"]:
-            return True
+def update_activity(user_id):
+    """Buffered: the timestamp reaches Mongo on the next activity flush"""
+    activity.touch(user_id)
+
+@timed_db
+async def update_profile(user_id, fields):
+    await users_collection.update_one({"_id": int(user_id)}, {"$set": fields})
+    patch_cached_user(user_id, fields)
+    forget_cards(user_id)
+
+@timed_db
+async def start_search(user_id):
+    """Marks the user as searching unless a concurrent pairing got there first"""
+    fields = {"status": "searching", "search_started": datetime.datetime.now()}
+    result = await users_collection.update_one({"_id": int(user_id), "status": {"$ne": "chatting"}}, {"$set": fields})
+    if not result.matched_count:
+        invalidate_user(user_id)
+        return False
+    patch_cached_user(user_id, fields)
+    return True
+
+@timed_db
+async def cancel_search(user_id):
+    """Sets a searcher back to idle; a user who got paired meanwhile is left alone"""
+    result = await users_collection.update_one({"_id": int(user_id), "status": "searching"}, {"$set": {"status": "idle"}})
+    if result.modified_count: patch_cached_user(user_id, {"status": "idle"})
+
+@timed_db
+async def expire_searches(user_ids):
+    await users_collection.update_many({"_id": {"$in": user_ids}, "status": "searching"}, {"$set": {"status": "idle"}})
+    for user_id in user_ids: invalidate_user(user_id)
+
+@timed_db
+async def find_stale_searchers(max_wait, limit=500):
+    """Multi-worker mode: this shard's searchers past their deadline, read from Mongo so restarts don't lose them"""
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_wait)
+    cursor = users_collection.find(
+        {"status": "searching", "search_started": {"$lt": cutoff}, "_id": {"$mod": [WORKERS, SHARD]}},
+        {"_id": 1}, limit=limit
+    )
+    return [doc["_id"] async for doc in cursor]
+
+@timed_db
+async def find_idle_chatters(after=None, limit=500):
+    """Chatting users whose stored last_active is past the idle timeout, in _id order after `after`,
+    with chat_partner and last_active"""
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=INACTIVITY_TIMEOUT)
+    # $not also matches users with no last_active at all
+    query = {"status": "chatting", "last_active": {"$not": {"$gte": cutoff}}}
+    ids = {"$mod": [WORKERS, SHARD]} if SHARDED else {}
+    if after is not None: ids["$gt"] = after
+    if ids: query["_id"] = ids
+    cursor = users_collection.find(query, {"chat_partner": 1, "last_active": 1}, sort=[("_id", ASCENDING)], limit=limit)
+    return await cursor.to_list(limit)
+
+@timed_db
+async def find_recent_searchers(max_age, limit=100):
+    """Multi-worker mode: this shard's searchers who started within max_age seconds, oldest first, with card and preference fields"""
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+    cursor = users_collection.find(
+        {"status": "searching", "search_started": {"$gte": cutoff}, "_id": {"$mod": [WORKERS, SHARD]}},
+        {"name": 1, "age": 1, "gender": 1, "bio": 1, "pref_gender": 1, "pref_age": 1},
+        sort=[("search_started", ASCENDING)], limit=limit
+    )
+    return await cursor.to_list(limit)
+
+@timed_db
+async def claim_search_partner(me, searching=False):
+    """Multi-worker mode: atomically takes the longest-waiting compatible searcher from Mongo and pairs with them.
+    Returns the partner's card fields, so the match message needs no extra read.
+    With searching=True, `me` is only paired if it is still searching (not cancelled in the meantime)."""
+    my_id = me["_id"]
+    excluded = list(await get_blocked_ids(my_id)) + await get_blocker_ids(my_id)
+    query = {
+        "status": "searching", "_id": {"$ne": my_id, "$nin": excluded},
+        "pref_gender": {"$in": [None, me.get("gender")]},
+        "$or": [{"pref_age": None}, {"pref_age.0": {"$lte": me.get("age")}, "pref_age.1": {"$gte": me.get("age")}}],
+    }
+    if me.get("pref_gender"): query["gender"] = me["pref_gender"]
+    if me.get("pref_age"): query["age"] = {"$gte": me["pref_age"][0], "$lte": me["pref_age"][1]}
+    partner = await users_collection.find_one_and_update(
+        query,
+        {"$set": {"prev_status": "searching", "status": "chatting", "chat_partner": my_id}},
+        sort=[("search_started", ASCENDING)], projection={"name": 1, "age": 1, "gender": 1, "bio": 1}
+    )
+    if not partner: return None
+    partner_id = partner["_id"]
+    result = await users_collection.update_one(
+        {"_id": my_id, "status": "searching" if searching else {"$ne": "chatting"}},
+        [{"$set": {"prev_status": "$status", "status": "chatting", "chat_partner": partner_id}}]
+    )
+    if not result.matched_count:
+        await users_collection.update_one({"_id": partner_id, "chat_partner": my_id}, {"$set": {"status": "searching", "chat_partner": None}})
+        invalidate_user(my_id)
+        invalidate_user(partner_id)
+        return None
+    patch_cached_user(my_id, {"status": "chatting", "chat_partner": partner_id})
+    patch_cached_user(partner_id, {"status": "chatting", "chat_partner": my_id})
+    open_session(my_id, partner_id)
+    return partner
+
+@timed_db
+async def set_chat_pair(user1_id, user2_id):
+    """Pairs both users in one bulk_write. Returns False if either side was already chatting."""
+    a, b = int(user1_id), int(user2_id)
+    # Out of the pool first so nobody else picks them during the write; a failed pair puts them back
+    matchmaker.remove(a)
+    matchmaker.remove(b)
+    # Pipeline updates keep the previous status so a failed pair can be undone exactly
+    result = await users_collection.bulk_write([
+        UpdateOne({"_id": a, "status": {"$ne": "chatting"}}, [{"$set": {"prev_status": "$status", "status": "chatting", "chat_partner": b}}]),
+        UpdateOne({"_id": b, "status": {"$ne": "chatting"}}, [{"$set": {"prev_status": "$status", "status": "chatting", "chat_partner": a}}]),
+    ])
+    if result.matched_count == 2:
+        patch_cached_user(a, {"status": "chatting", "chat_partner": b})
+        patch_cached_user(b, {"status": "chatting", "chat_partner": a})
+        open_session(a, b)
+        return True
+    if result.matched_count:
+        await users_collection.update_many(
+            {"$or": [{"_id": a, "chat_partner": b}, {"_id": b, "chat_partner": a}]},
+            [{"$set": {"status": {"$ifNull": ["$prev_status", "idle"]}, "chat_partner": None}}]
+        )
+    invalidate_user(a)
+    invalidate_user(b)
+    if not SHARDED: await asyncio.gather(requeue_if_searching(a), requeue_if_searching(b))
     return False
 
-def find_search_partner(my_id):
-    me = get_user(my_id)
-    my_blocks = me.get("blocked_users", []) if me else []
-    pipeline = [
-        {
-            "$match": {
-                "status": "searching", 
-                "_id": {"$ne": int(my_id), "$nin": my_blocks}, 
-                "blocked_users": {"$ne": int(my_id)} 
-            }
-        }, 
-        {"$sample": {"size": 1}}
-    ]
-    result = list(users_collection.aggregate(pipeline))
-    if result:
-        return result[0]
+@timed_db
+async def clear_chat_pair(user_id):
+    """Unpairs in one round trip. Returns the partner only if this call ended the chat."""
+    user = await get_user(user_id)
+    if not user or not user.get("chat_partner"): return None
+    a, b = int(user_id), int(user["chat_partner"])
+    # Only touch documents that still point at each other, so a partner who moved on is left alone
+    result = await users_collection.update_many(
+        {"$or": [{"_id": a, "chat_partner": b}, {"_id": b, "chat_partner": a}]},
+        {"$set": {"status": "idle", "chat_partner": None}}
+    )
+    close_session(a, b)
+    if result.modified_count == 2:
+        patch_cached_user(a, {"status": "idle", "chat_partner": None})
+        patch_cached_user(b, {"status": "idle", "chat_partner": None})
+        return b
+    invalidate_user(a)
+    invalidate_user(b)
     return None
 
+@timed_db
+async def find_blocked_ids(user_id):
+    return {doc["blocked"] async for doc in blocks_collection.find({"blocker": user_id}, {"blocked": 1})}
+
+async def get_blocked_ids(user_id):
+    """Ids this user has blocked, as a cached set (misses are timed as find_blocked_ids)"""
+    user_id = int(user_id)
+    blocked = block_cache.get(user_id)
+    if blocked is None: blocked = await block_cache.fill(user_id, lambda: find_blocked_ids(user_id))
+    return blocked
+
+@timed_db
+async def load_blocked_ids(user_ids):
+    """Batch version of get_blocked_ids for many users at once (one query)"""
+    result = {user_id: set() for user_id in user_ids}
+    async for doc in blocks_collection.find({"blocker": {"$in": list(user_ids)}}, {"blocker": 1, "blocked": 1}):
+        result[doc["blocker"]].add(doc["blocked"])
+    for user_id, blocked in result.items(): block_cache.set(user_id, blocked)
+    return result
+
+@timed_db
+async def get_blocker_ids(user_id):
+    """Ids of users who blocked this user (only needed by the Mongo-side matcher)"""
+    return [doc["blocker"] async for doc in blocks_collection.find({"blocked": int(user_id)}, {"blocker": 1})]
+
+def _set_cached_blocks(user_id, blocked):
+    block_cache.written(user_id)
+    if blocked is not None: block_cache.set(user_id, blocked)
+    broadcast_invalidation(user_id, "invalidate_blocks")
+
+@timed_db
+async def block_user(user_id, target_id):
+    user_id, target_id = int(user_id), int(target_id)
+    matchmaker.add_block(user_id, target_id)
+    await blocks_collection.update_one(
+        {"_id": f"{user_id}:{target_id}"}, {"$setOnInsert": {"blocker": user_id, "blocked": target_id}}, upsert=True
+    )
+    blocked = block_cache.peek(user_id)
+    _set_cached_blocks(user_id, blocked | {target_id} if blocked is not None else None)
+    log_shipper.emit(f"🚫 <b>Block</b>\n<code>{user_id}</code> blocked <code>{target_id}</code>")
+
+@timed_db
+async def unblock_user(user_id, target_id):
+    user_id, target_id = int(user_id), int(target_id)
+    await blocks_collection.delete_one({"_id": f"{user_id}:{target_id}"})
+    blocked = block_cache.peek(user_id)
+    _set_cached_blocks(user_id, blocked - {target_id} if blocked is not None else None)
+
+async def is_blocked(user_id, target_id):
+    """True if either user has blocked the other"""
+    return int(target_id) in await get_blocked_ids(user_id) or int(user_id) in await get_blocked_ids(target_id)
+
+async def migrate_block_lists(batch_size=500):
+    """Moves legacy blocked_users arrays into the blocks collection (idempotent).
+    One pass of a single cursor over the unindexed filter, with the writes batched as it goes."""
+    if await meta_collection.find_one({"_id": "blocks_migrated"}): return 0
+    migrated = 0
+    async def move(users):
+        ops = [
+            UpdateOne({"_id": f"{user['_id']}:{target}"}, {"$setOnInsert": {"blocker": user["_id"], "blocked": int(target)}}, upsert=True)
+            for user in users for target in user["blocked_users"]
+        ]
+        await blocks_collection.bulk_write(ops, ordered=False)
+        ids = [user["_id"] for user in users]
+        await users_collection.update_many({"_id": {"$in": ids}}, {"$unset": {"blocked_users": ""}})
+        for user_id in ids: invalidate_user(user_id)
+    batch = []
+    async for user in users_collection.find({"blocked_users.0": {"$exists": True}}, {"blocked_users": 1}).batch_size(batch_size):
+        batch.append(user)
+        if len(batch) == batch_size:
+            await move(batch)
+            migrated, batch = migrated + len(batch), []
+    if batch:
+        await move(batch)
+        migrated += len(batch)
+    await meta_collection.update_one({"_id": "blocks_migrated"}, {"$set": {"at": datetime.datetime.now()}}, upsert=True)
+    return migrated
+
 # --- JOB QUEUE (TIMEOUTS) ---
 
-async def search_timeout_task(context: ContextTypes.DEFAULT_TYPE):
-    """Stops search if no partner found in 60s"""
-    job = context.job
-    user_id = job.data
-    user = get_user(user_id)
-    
-    if user and user.get("status") == "searching":
-        set_status(user_id, "idle")
-        try:
-            keyboard = [[InlineKeyboardButton("🔄 Try Again", callback_data="search")]]
-            await context.bot.send_message(
-                user_id, 
-                "💤 **Search timed out.**\nNo active partners found right now.", 
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
-            )
-        except: pass
+async def search_timeout_task(bot, user_id):
+    """Tells a searcher that no partner was found in 60s"""
+    try: await bot.send_message(user_id, SEARCH_TIMEOUT_TEXT, reply_markup=RETRY_SEARCH_KEYBOARD, parse_mode=ParseMode.MARKDOWN, rate_limit_args=BULK)
+    except: pass
 
-async def inactivity_timeout_task(context: ContextTypes.DEFAULT_TYPE):
+async def requeue_if_searching(user_id):
+    user = await get_user(user_id)
+    if user and user.get("status") == "searching": matchmaker.enqueue(user, await get_blocked_ids(user_id))
+
+async def announce_match(context, user_id, partner_id):
+    # A failed pair requeues whoever is still searching
+    if await set_chat_pair(user_id, partner_id):
+        user, partner = await asyncio.gather(get_user(user_id), get_user(partner_id))
+        if user and partner: await send_match_messages(context, user, partner)
+
+@timed_handler
+async def search_sweep_task(context: ContextTypes.DEFAULT_TYPE):
+    """Expires every stale searcher with one update_many and notifies them concurrently.
+    Also pairs waiters whose preferences have widened since the last sweep (in multi-worker mode, retries new searchers' claims)."""
+    if not SHARDED:
+        pairs = matchmaker.rematch_widened()
+        if pairs: await asyncio.gather(*(announce_match(context, a, b) for a, b in pairs))
+    else:
+        # Two searchers claiming at the same moment can both miss (or roll back) each other, so give every new
+        # searcher one more claim; sequential, so this shard's own searchers never claim each other concurrently
+        for me in await find_recent_searchers(2 * SEARCH_SWEEP_INTERVAL):
+            partner = await claim_search_partner(me, searching=True)
+            if partner: await send_match_messages(context, me, partner)
+    expired = await find_stale_searchers(SEARCH_TIMEOUT) if SHARDED else matchmaker.expire(SEARCH_TIMEOUT)
+    if "searching" in leftovers:
+        # Searchers the startup pass never reached aren't in the pool, but Mongo knows when they started
+        stale = [user_id for user_id in await find_stale_searchers(SEARCH_TIMEOUT) if user_id not in matchmaker.waiting and user_id not in expired]
+        page_done("searching", stale)
+        expired += stale
+    if expired:
+        await expire_searches(expired)
+        await asyncio.gather(*(search_timeout_task(context.bot, user_id) for user_id in expired))
+
+async def inactivity_timeout_task(bot, user_id, partner_id):
     """Disconnects chat if no messages for 5 mins"""
-    job = context.job
-    user_id = job.data
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
-    # Only act if they are still chatting
-    if user and user.get("status") == "chatting":
-        partner_id = clear_chat_pair(user_id) # Disconnects both in DB
-        
-        msg = "⏳ **Chat ended due to inactivity.**\n(5 minutes with no messages)\n\nType /search to find a new partner."
-        keyboard = [[InlineKeyboardButton("💬 Find New Partner", callback_data="search")]]
+    # Only act if they are still chatting with each other
+    if user and user.get("status") == "chatting" and user.get("chat_partner") == partner_id:
+        partner_id = await clear_chat_pair(user_id) # Disconnects both in DB
         
         try: 
-            await context.bot.send_message(user_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+            await bot.send_message(user_id, INACTIVITY_TEXT, reply_markup=FIND_PARTNER_KEYBOARD, parse_mode=ParseMode.MARKDOWN, rate_limit_args=BULK)
         except: pass
         
         if partner_id:
             try: 
-                await context.bot.send_message(partner_id, msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+                await bot.send_message(partner_id, INACTIVITY_TEXT, reply_markup=FIND_PARTNER_KEYBOARD, parse_mode=ParseMode.MARKDOWN, rate_limit_args=BULK)
             except: pass
 
-def reset_inactivity_timer(context, user_id, partner_id):
+@timed_handler
+async def inactivity_sweep_task(context: ContextTypes.DEFAULT_TYPE):
+    """Ends every session whose idle deadline has passed, in one batch"""
+    if "chatting" in leftovers:
+        # Sessions the startup pass never reached have no deadline here. Page through them by _id and settle each
+        # pair like the startup pass would: a deadline from the later of both last_actives, or a repair if it's broken
+        after, found = leftover_passes.get("chatting", (None, False))
+        page = await find_idle_chatters(after, RECONCILE_BATCH)
+        broken, unpaired = [], {}
+        for doc in page:
+            user_id, partner_id = doc["_id"], doc.get("chat_partner")
+            if not partner_id: broken.append((user_id, None))
+            elif session_key(user_id, partner_id) not in inactivity and unpaired.get(partner_id, (None,))[0] != user_id:
+                unpaired[user_id] = (partner_id, doc.get("last_active"))
+        await _repair_half_pairs(broken)
+        if unpaired: await _settle_chatting(unpaired, datetime.datetime.now(), time.monotonic())
+        found = found or bool(broken or unpaired)
+        if len(page) < RECONCILE_BATCH:
+            # End of a pass: the next one starts over, unless this one found nothing left to settle
+            leftover_passes.pop("chatting", None)
+            page_done("chatting", found)
+        else: leftover_passes["chatting"] = (page[-1]["_id"], found)
+    expired = inactivity.expire()
+    if expired:
+        await asyncio.gather(*(inactivity_timeout_task(context.bot, a, b) for a, b in expired))
+
+def reset_inactivity_timer(user_id, partner_id):
     """Resets the 5-minute timer whenever a message is sent"""
-    if not context.job_queue: return
-    
-    # 1. Clear old timers for both users
-    for uid in [user_id, partner_id]:
-        jobs = context.job_queue.get_jobs_by_name(f"inactivity_{uid}")
-        for job in jobs: job.schedule_removal()
-    
-    # 2. Start a new single timer (linked to sender)
-    # 300 seconds = 5 minutes
-    context.job_queue.run_once(inactivity_timeout_task, 300, data=user_id, name=f"inactivity_{user_id}")
+    key = session_key(user_id, partner_id)
+    inactivity.touch(key)
+    # The partner's worker only sees the partner's messages, so keep its timer roughly in sync
+    if SHARDED and shard_for(partner_id) != SHARD:
+        now = time.monotonic()
+        if now - forwarded_touches.get(key, 0) >= CROSS_SHARD_TOUCH_INTERVAL:
+            forwarded_touches[key] = now
+            publish(shard_for(partner_id), "touch", key)
+
+RECONCILE_BATCH = 1000  # documents per round of repairs/lookups
+RECONCILE_TIME_BUDGET = 30  # seconds; whatever is left is paged through by the sweeps
+
+# Set when the startup pass ran out of time: kind -> wall time after which a sweep pass that finds nothing means none are left
+leftovers = {}
+leftover_passes = {}  # kind -> (last _id the sweeps' paging reached, whether this pass found anything)
+
+def page_done(kind, found):
+    if not found and datetime.datetime.now() > leftovers[kind]: del leftovers[kind]
+
+def _monotonic_at(stamp, wall_now, mono_now):
+    """Maps a stored datetime onto the monotonic clock the timers use (missing = now)"""
+    return mono_now - max(0.0, (wall_now - stamp).total_seconds()) if stamp else mono_now
+
+async def _repair_half_pairs(pairs):
+    """Resets (user_id, partner_id) docs whose partner doesn't point back, in one update_many"""
+    if not pairs: return 0
+    result = await users_collection.update_many(
+        {"status": "chatting", "$or": [{"_id": user_id, "chat_partner": partner_id} for user_id, partner_id in pairs]},
+        {"$set": {"status": "idle", "chat_partner": None}}
+    )
+    for user_id, _ in pairs: invalidate_user(user_id)
+    return result.modified_count
+
+async def _settle_chatting(unpaired, wall_now, mono_now):
+    """Checks partners that weren't in the stream (other shard, or not chatting) with one $in lookup"""
+    partners = {}
+    async for doc in users_collection.find({"_id": {"$in": [partner_id for partner_id, _ in unpaired.values()]}}, {"status": 1, "chat_partner": 1, "last_active": 1}):
+        partners[doc["_id"]] = doc
+    broken = []
+    for user_id, (partner_id, last_active) in unpaired.items():
+        partner = partners.get(partner_id)
+        if partner and partner.get("status") == "chatting" and partner.get("chat_partner") == user_id:
+            seen = max(filter(None, (last_active, partner.get("last_active"))), default=None)
+            open_session(user_id, partner_id, _monotonic_at(seen, wall_now, mono_now) + INACTIVITY_TIMEOUT)
+        else: broken.append((user_id, partner_id))
+    return len(unpaired) - len(broken), await _repair_half_pairs(broken)
+
+async def reconcile_sessions():
+    """Rebuilds sessions, idle deadlines and (single-process) the search pool from Mongo after a restart.
+
+    Both queries run on indexes and are streamed in batches. Pairs whose partner
+    doesn't point back are reset in bulk. Deadlines come from the stored
+    last_active/search_started, so a restart doesn't extend anyone's timeout.
+    Whatever doesn't fit in RECONCILE_TIME_BUDGET is left to the sweeps, which page
+    through it by the same indexes until every leftover has timed out.
+    """
+    started = time.monotonic()
+    give_up = started + RECONCILE_TIME_BUDGET
+    wall_now, mono_now = datetime.datetime.now(), time.monotonic()
+    shard_filter = {"_id": {"$mod": [WORKERS, SHARD]}} if SHARDED else {}
+    pairs = repaired = searchers = 0
+    complete = True
+
+    # Chatting users: status_last_active index. A doc waits in `unpaired` until its partner shows up.
+    unpaired = {}  # user_id -> (partner_id, last_active)
+    broken = []
+    cursor = users_collection.find({"status": "chatting", **shard_filter}, {"chat_partner": 1, "last_active": 1}).batch_size(RECONCILE_BATCH)
+    async for doc in cursor:
+        user_id, partner_id = doc["_id"], doc.get("chat_partner")
+        if not partner_id: broken.append((user_id, None))
+        elif partner_id in unpaired and unpaired[partner_id][0] == user_id:
+            seen = max(filter(None, (doc.get("last_active"), unpaired.pop(partner_id)[1])), default=None)
+            open_session(user_id, partner_id, _monotonic_at(seen, wall_now, mono_now) + INACTIVITY_TIMEOUT)
+            pairs += 1
+        else: unpaired[user_id] = (partner_id, doc.get("last_active"))
+        if len(broken) >= RECONCILE_BATCH:
+            repaired += await _repair_half_pairs(broken)
+            broken = []
+        if time.monotonic() > give_up:
+            complete = False
+            break
+    repaired += await _repair_half_pairs(broken)
+    if complete:
+        # Partners never seen are either on another shard or no longer pointing back
+        items = list(unpaired.items())
+        for i in range(0, len(items), RECONCILE_BATCH):
+            settled, fixed = await _settle_chatting(dict(items[i:i + RECONCILE_BATCH]), wall_now, mono_now)
+            pairs, repaired = pairs + settled, repaired + fixed
+    else: leftovers["chatting"] = wall_now + datetime.timedelta(seconds=INACTIVITY_TIMEOUT)
+
+    # Searchers: the partial searching_since index, oldest first as the pool expects
+    if complete and not SHARDED:
+        fields = {"gender": 1, "age": 1, "pref_gender": 1, "pref_age": 1, "search_started": 1}
+        cursor = users_collection.find({"status": "searching"}, fields).sort("search_started", ASCENDING).batch_size(RECONCILE_BATCH)
+        batch = []
+        async def enqueue(batch):
+            blocks = await load_blocked_ids([doc["_id"] for doc in batch])
+            # Searches already past SEARCH_TIMEOUT are expired (and notified) by the next sweep
+            for doc in batch: matchmaker.enqueue(doc, blocks[doc["_id"]], _monotonic_at(doc.get("search_started"), wall_now, mono_now))
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) == RECONCILE_BATCH:
+                await enqueue(batch)
+                searchers, batch = searchers + len(batch), []
+            if time.monotonic() > give_up:
+                complete = False
+                break
+        if batch:
+            await enqueue(batch)
+            searchers += len(batch)
+    if not complete and not SHARDED: leftovers["searching"] = wall_now + datetime.timedelta(seconds=SEARCH_TIMEOUT)
+
+    elapsed = time.monotonic() - started
+    logger.info(f"Reconciled {pairs} pairs and {searchers} searchers, repaired {repaired} half-pairs in {elapsed:.1f}s")
+    if not complete: logger.warning(f"Reconciliation stopped after its {RECONCILE_TIME_BUDGET}s budget; the sweeps page through the rest")
+    return pairs, searchers, repaired
+
+# --- OUTBOUND RATE LIMITING ---
+
+# Priority lanes: lower is served first when a bucket runs dry
+PRIORITY_RELAY, PRIORITY_NOTICE, PRIORITY_BULK = 0, 1, 2
+RELAY = {"priority": PRIORITY_RELAY}
+BULK = {"priority": PRIORITY_BULK}
+
+GLOBAL_SEND_RATE = 30  # messages/sec across all chats (Telegram's bot-wide limit)
+GLOBAL_SEND_BURST = 3  # kept small: a full bucket on top of the rate would overshoot the limit in the first second
+CHAT_SEND_RATE, CHAT_SEND_BURST = 1, 3  # per private chat
+MAX_SEND_RETRIES = 3
+RATE_LIMITED_ENDPOINTS = ("send", "copyMessage", "forwardMessage", "editMessage")
+
+class TokenBucket:
+    """Token bucket whose waiters are released by priority, then FIFO"""
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waiters = []  # heap of (priority, seq, future)
+        self.seq = itertools.count()
+        self.drainer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def idle(self):
+        self._refill()
+        return not self.waiters and self.tokens >= self.burst
+
+    async def acquire(self, priority=PRIORITY_NOTICE):
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.drainer is None or self.drainer.done():
+            self.drainer = asyncio.create_task(self._drain())
+        await future
+
+    async def _drain(self):
+        while self.waiters:
+            self._refill()
+            while self.waiters and self.tokens >= 1:
+                _, _, future = heapq.heappop(self.waiters)
+                if future.done(): continue  # waiter was cancelled
+                self.tokens -= 1
+                future.set_result(None)
+            if self.waiters: await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Outbound governor for every Bot API call made through the application.
+
+    Sends wait on a per-chat bucket and the global bucket, with relayed chat
+    messages jumping ahead of notifications. A RetryAfter pauses all sends for
+    the requested time and the call is retried. Pass rate_limit_args=RELAY/BULK
+    to pick a lane; anything else is a notification.
+    """
+
+    def __init__(self, max_retries=MAX_SEND_RETRIES):
+        # Workers share the bot-wide limit, burst included
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE / WORKERS, max(1, GLOBAL_SEND_BURST / WORKERS))
+        self.chat_buckets = {}
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.sent = self.retried = self.waits = 0
+        self.wait_total = self.wait_max = 0.0
+        self.errors = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def queue_depth(self):
+        return len(self.global_bucket.waiters) + sum(len(b.waiters) for b in self.chat_buckets.values())
+
+    def avg_wait(self):
+        return self.wait_total / self.waits if self.waits else 0.0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+        return bucket
+
+    async def _wait_for_slot(self, chat_id, priority):
+        start = time.monotonic()
+        if self.paused_until > start: await asyncio.sleep(self.paused_until - start)
+        if chat_id is not None: await self._chat_bucket(chat_id).acquire(priority)
+        await self.global_bucket.acquire(priority)
+        waited = time.monotonic() - start
+        metrics.observe("outbound_queue_wait_seconds", waited, priority=priority)
+        self.waits += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(RATE_LIMITED_ENDPOINTS)
+        priority = (rate_limit_args or {}).get("priority", PRIORITY_NOTICE)
+        for attempt in range(self.max_retries + 1):
+            if limited: await self._wait_for_slot(data.get("chat_id"), priority)
+            start = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                metrics.inc("bot_api_errors_total", endpoint=endpoint, error="RetryAfter")
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                self.retried += 1
+                if attempt == self.max_retries:
+                    self.errors["RetryAfter"] += 1
+                    raise
+                if not limited: await asyncio.sleep(delay)
+            except Exception as e:
+                self.errors[type(e).__name__] += 1
+                metrics.inc("bot_api_errors_total", endpoint=endpoint, error=type(e).__name__)
+                logger.debug(f"{endpoint} failed: {e}")
+                raise
+            finally: metrics.observe("bot_api_seconds", time.perf_counter() - start, endpoint=endpoint)
+
+rate_limiter = PriorityRateLimiter()
+
+metrics.gauge("active_pairs", lambda: len(inactivity))
+metrics.gauge("searching_users", lambda: len(matchmaker))
+metrics.gauge("outbound_queue_depth", rate_limiter.queue_depth)
+metrics.gauge("outbound_retries_total", lambda: rate_limiter.retried)
+metrics.gauge("user_cache_hits_total", lambda: user_cache.hits)
+metrics.gauge("user_cache_misses_total", lambda: user_cache.misses)
+metrics.gauge("user_cache_size", lambda: len(user_cache))
+metrics.gauge("activity_pending", lambda: len(activity))
+metrics.gauge("log_queue_depth", lambda: len(log_shipper))
+metrics.gauge("conversation_drafts", lambda: len(drafts))
+
+# --- UPDATE PROCESSING ---
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently across users but in arrival order per user"""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.locks = {}  # user_id -> [lock, pending updates]
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self.locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Queue on the user's lock before taking a concurrency slot, so one busy user can't hog the slots
+            async with entry[0]: await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]: del self.locks[user.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # --- FORCE SUB LOGIC ---
 
-async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Members are re-checked every 10 min, non-members after 30s so joining unlocks quickly
+SUB_MEMBER_TTL, SUB_NON_MEMBER_TTL, INVITE_LINK_TTL = 600, 30, 3600
+sub_cache = TTLCache(USER_CACHE_SIZE, SUB_MEMBER_TTL)
+invite_link_cache = TTLCache(1, INVITE_LINK_TTL)
+
+def sub_api_calls_saved():
+    return sub_cache.hits + invite_link_cache.hits
+
+@timed_handler
+async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, refresh=False):
     user_id = update.effective_user.id
-    try:
-        member = await context.bot.get_chat_member(chat_id=UPDATE_CHANNEL_ID, user_id=user_id)
-        if member.status in [ChatMember.LEFT, ChatMember.BANNED]:
-            await send_force_sub_message(update, context)
-            return False
-        return True
-    except Exception as e:
-        # If bot is not admin in channel, let user pass (fail-safe)
-        return True
+    if refresh: sub_cache.pop(user_id)
+    subscribed = sub_cache.get(user_id)
+    if subscribed is None:
+        try:
+            member = await context.bot.get_chat_member(chat_id=UPDATE_CHANNEL_ID, user_id=user_id)
+            subscribed = member.status not in [ChatMember.LEFT, ChatMember.BANNED]
+        except Exception as e:
+            # If bot is not admin in channel, let user pass (fail-safe, not cached)
+            return True
+        sub_cache.set(user_id, subscribed, None if subscribed else SUB_NON_MEMBER_TTL)
+    if not subscribed: await send_force_sub_message(update, context)
+    return subscribed
+
+async def get_invite_link(bot):
+    link = invite_link_cache.get(UPDATE_CHANNEL_ID)
+    if link is None:
+        try:
+            chat = await bot.get_chat(UPDATE_CHANNEL_ID)
+            link = chat.invite_link if chat.invite_link else f"https://t.me/{chat.username}"
+            invite_link_cache.set(UPDATE_CHANNEL_ID, link)
+        except: link = "https://t.me/telegram"
+    return link
 
+@timed_handler
 async def send_force_sub_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        chat = await context.bot.get_chat(UPDATE_CHANNEL_ID)
-        link = chat.invite_link if chat.invite_link else f"https://t.me/{chat.username}"
-    except: link = "https://t.me/telegram"
+    link = await get_invite_link(context.bot)
     text = "🔒 **Locked Access**\n\nTo use this bot, you must join our update channel first."
     keyboard = [[InlineKeyboardButton("📢 Join Channel", url=link)], [InlineKeyboardButton("✅ I Joined", callback_data="check_sub")]]
     if update.callback_query: await update.callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
@@ -209,28 +1222,117 @@ async def send_force_sub_message(update: Update, context: ContextTypes.DEFAULT_T
 REG_NAME, REG_AGE, REG_GENDER, REG_BIO, REG_PHOTO = range(5)
 EDIT_SELECT, EDIT_UPDATE = range(5, 7)
 
+# --- CONVERSATION STATE ---
+
+DRAFT_CACHE_SIZE = int(os.getenv("DRAFT_CACHE_SIZE", "200000"))
+DRAFT_TTL = int(os.getenv("DRAFT_TTL", "3600"))  # abandoned registrations/edits are dropped after this
+PERSIST_CONVERSATIONS = os.getenv("PERSIST_CONVERSATIONS", "true").lower() != "false"
+CONVERSATION_FLUSH_INTERVAL = 10  # seconds; PTB hands us changed states this often
+
+class PersistentDraftStore(DraftStore):
+    """DraftStore whose changes are written behind to the drafts collection in one bulk_write"""
+
+    async def flush(self):
+        if not self.dirty: return
+        dirty, self.dirty = self.dirty, set()
+        now = datetime.datetime.now()
+        ops = []
+        for user_id in dirty:
+            draft = self.get(user_id)
+            if draft is None: ops.append(DeleteOne({"_id": user_id}))
+            else: ops.append(UpdateOne({"_id": user_id}, {"$set": {**draft.to_doc(), "updated": now}}, upsert=True))
+        try: await drafts_collection.bulk_write(ops, ordered=False)
+        except Exception:
+            self.dirty |= dirty
+            raise
+
+    async def load(self):
+        """Restores drafts that are still within their TTL after a restart"""
+        wall_now, mono_now = datetime.datetime.now(), time.monotonic()
+        query = {"updated": {"$gt": wall_now - datetime.timedelta(seconds=self.ttl)}}
+        if SHARDED: query["_id"] = {"$mod": [WORKERS, SHARD]}
+        loaded = 0
+        async for doc in drafts_collection.find(query).sort("updated", ASCENDING):
+            self._put(doc["_id"], Draft(**doc), _monotonic_at(doc["updated"], wall_now, mono_now) + self.ttl)
+            loaded += 1
+        return loaded
+
+drafts = PersistentDraftStore(DRAFT_CACHE_SIZE, DRAFT_TTL, PERSIST_CONVERSATIONS)
+
+class MongoPersistence(BasePersistence):
+    """Persists only ConversationHandler states (and, alongside them, the drafts).
+
+    PTB calls update_conversation for every changed state once per update_interval.
+    Those calls are collected and written in a single unordered bulk_write.
+    """
+
+    def __init__(self):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False), update_interval=CONVERSATION_FLUSH_INTERVAL)
+        self.pending = {}  # (name, key) -> state, None = ended
+        self.writer = None
+
+    async def get_conversations(self, name):
+        query = {"name": name, "updated": {"$gt": datetime.datetime.now() - datetime.timedelta(seconds=DRAFT_TTL)}}
+        if SHARDED: query["user_id"] = {"$mod": [WORKERS, SHARD]}
+        return {tuple(doc["key"]): doc["state"] async for doc in conversations_collection.find(query, {"key": 1, "state": 1})}
+
+    async def update_conversation(self, name, key, new_state):
+        self.pending[(name, tuple(key))] = new_state
+        # The other changed states of this round are queued before the writer task runs
+        if self.writer is None or self.writer.done(): self.writer = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        while self.pending:
+            pending, self.pending = self.pending, {}
+            now = datetime.datetime.now()
+            ops = []
+            for (name, key), state in pending.items():
+                doc_id = f"{name}:{':'.join(map(str, key))}"
+                if state is None: ops.append(DeleteOne({"_id": doc_id}))
+                else: ops.append(UpdateOne({"_id": doc_id}, {"$set": {"name": name, "key": list(key), "user_id": key[-1], "state": state, "updated": now}}, upsert=True))
+            try: await conversations_collection.bulk_write(ops, ordered=False)
+            except Exception as e:
+                for item, state in pending.items(): self.pending.setdefault(item, state)
+                logger.warning(f"Conversation flush failed: {e}")
+                break
+        try: await drafts.flush()
+        except Exception as e: logger.warning(f"Draft flush failed: {e}")
+
+    # Nothing but conversations is persisted
+    async def get_user_data(self): return {}
+    async def get_chat_data(self): return {}
+    async def get_bot_data(self): return {}
+    async def get_callback_data(self): return None
+    async def update_user_data(self, user_id, data): pass
+    async def update_chat_data(self, chat_id, data): pass
+    async def update_bot_data(self, data): pass
+    async def update_callback_data(self, data): pass
+    async def drop_user_data(self, user_id): pass
+    async def drop_chat_data(self, chat_id): pass
+    async def refresh_user_data(self, user_id, user_data): pass
+    async def refresh_chat_data(self, chat_id, chat_data): pass
+    async def refresh_bot_data(self, bot_data): pass
+
 # --- START ---
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await check_subscription(update, context): return
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
-    try:
-        first_name = html.escape(update.effective_user.first_name or "Unknown")
-        username = html.escape(update.effective_user.username or "None")
-        log_text = f"👤 <b>New Session</b>\n🆔 ID: <code>{user_id}</code>\n📛 Name: {first_name}\n🔗 Username: @{username}"
-        await context.bot.send_message(LOG_GROUP_ID, log_text, parse_mode=ParseMode.HTML)
-    except: pass
+    first_name = html.escape(update.effective_user.first_name or "Unknown")
+    username = html.escape(update.effective_user.username or "None")
+    log_shipper.emit(f"👤 <b>New Session</b>\n🆔 ID: <code>{user_id}</code>\n📛 Name: {first_name}\n🔗 Username: @{username}")
 
     if not user and context.args:
         referrer_arg = context.args[0]
         if referrer_arg.startswith("ref_"):
             try:
                 referrer_id = int(referrer_arg.split("_")[1])
-                if referrer_id != user_id:
-                    add_coins(referrer_id, 100)
-                    await context.bot.send_message(referrer_id, "🎉 **Referral Bonus!**\nYou earned **100 Coins**!", parse_mode=ParseMode.MARKDOWN)
+                # Keyed by the referee, so repeated /start floods credit at most once
+                if referrer_id != user_id and await credit_coins(referrer_id, REFERRAL_BONUS, f"referral:{user_id}", "referral") is not None:
+                    await context.bot.send_message(referrer_id, f"🎉 **Referral Bonus!**\nYou earned **{REFERRAL_BONUS} Coins**!", parse_mode=ParseMode.MARKDOWN)
             except: pass
 
     if user:
@@ -241,171 +1343,217 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("👋 **Welcome!**\nLet's create your profile to get started.\n\n👉 **What is your name?**", reply_markup=ReplyKeyboardRemove(), parse_mode=ParseMode.MARKDOWN)
         return REG_NAME
 
+@timed_handler
 async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if user: await send_profile_menu(update, context, user)
     else: await update.message.reply_text("⚠️ Register first with /start")
 
 async def send_profile_menu(update, context, user):
-    caption = (
-        f"💎 **YOUR PROFILE** 💎\n\n"
-        f"👤 **Name:** {user.get('name')}\n"
-        f"🎂 **Age:** {user.get('age')}\n"
-        f"⚧ **Gender:** {user.get('gender')}\n"
-        f"💰 **Coins:** `{user.get('coins', 0)}`\n"
-        f"📝 **Bio:** {user.get('bio')}\n\n"
-        "📜 **COMMANDS LIST:**\n"
-        "🔎 /search - Find Random Partner\n"
-        "💌 /chat `[ID]` - Direct Request\n"
-        "🛑 /stop - End Current Chat\n"
-        "➡️ /next - Skip Partner\n"
-        "🚫 /block - Block User\n"
-        "💰 /balance - Check Coins\n"
-        "🎁 /referral - Invite & Earn\n\n"
-        "━━━━━━━━━━━━━━━━━━\n"
-        "🚀 **Ready to chat?**\n"
-        "Click the button below to find a partner!"
-    )
-    keyboard = [[InlineKeyboardButton("💬 Start Chatting", callback_data="search")], [InlineKeyboardButton("✏️ Edit Profile", callback_data="edit")]]
+    caption = profile_card(user)
     chat_id = update.effective_chat.id
     if user.get("photo_id"):
-        try: await context.bot.send_photo(chat_id, user.get("photo_id"), caption=caption, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(keyboard), protect_content=True)
-        except: await context.bot.send_message(chat_id, caption, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(keyboard), protect_content=True)
+        try: await context.bot.send_photo(chat_id, user.get("photo_id"), caption=caption, parse_mode=ParseMode.MARKDOWN, reply_markup=PROFILE_KEYBOARD, protect_content=True)
+        except: await context.bot.send_message(chat_id, caption, parse_mode=ParseMode.MARKDOWN, reply_markup=PROFILE_KEYBOARD, protect_content=True)
     else:
-        await context.bot.send_message(chat_id, caption, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(keyboard), protect_content=True)
+        await context.bot.send_message(chat_id, caption, parse_mode=ParseMode.MARKDOWN, reply_markup=PROFILE_KEYBOARD, protect_content=True)
 
 # --- REGISTRATION STEPS ---
 
+@timed_handler
 async def reg_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['name'] = update.message.text
+    drafts.update(update.effective_user.id, name=update.message.text)
     await update.message.reply_text("✨ Nice name! **How old are you?**", parse_mode=ParseMode.MARKDOWN)
     return REG_AGE
 
+@timed_handler
 async def reg_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         age = int(update.message.text)
         if age < 18:
+            drafts.discard(update.effective_user.id)
             await update.message.reply_text("🔞 Sorry, you must be 18+ to use this bot.")
             return ConversationHandler.END
-        context.user_data['age'] = age
-        keyboard = [["Male", "Female"]]
-        await update.message.reply_text("⚧ **Select your gender:**", reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True), parse_mode=ParseMode.MARKDOWN)
+        drafts.update(update.effective_user.id, age=age)
+        await update.message.reply_text("⚧ **Select your gender:**", reply_markup=GENDER_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
         return REG_GENDER
     except:
         await update.message.reply_text("🔢 Please enter a valid number for age.")
         return REG_AGE
 
+@timed_handler
 async def reg_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     gender = update.message.text
     if gender not in ["Male", "Female"]:
         await update.message.reply_text("Please select a valid gender option.")
         return REG_GENDER
-    context.user_data['gender'] = gender
+    drafts.update(update.effective_user.id, gender=gender)
     await update.message.reply_text("📝 **Write a short bio about yourself:**", reply_markup=ReplyKeyboardRemove(), parse_mode=ParseMode.MARKDOWN)
     return REG_BIO
 
+@timed_handler
 async def reg_bio(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data['bio'] = update.message.text
+    drafts.update(update.effective_user.id, bio=update.message.text)
     await update.message.reply_text("📸 **Almost done! Send a photo for your profile.**", parse_mode=ParseMode.MARKDOWN)
     return REG_PHOTO
 
+@timed_handler
 async def reg_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo: return REG_PHOTO
     photo_file = update.message.photo[-1].file_id
-    add_user(update.effective_user.id, context.user_data['name'], context.user_data['age'], context.user_data['gender'], context.user_data['bio'], photo_file, update.effective_user.username)
-    add_coins(update.effective_user.id, 50) 
-    await update.message.reply_text("✅ **All set!** You received **50 Free Coins**.\n\nType /search to start chatting!", parse_mode=ParseMode.MARKDOWN)
+    draft = drafts.get(update.effective_user.id)
+    if draft is None or None in (draft.name, draft.age, draft.gender, draft.bio):
+        await update.message.reply_text("⌛ Your registration expired. Type /start to begin again.")
+        return ConversationHandler.END
+    await add_user(update.effective_user.id, draft.name, draft.age, draft.gender, draft.bio, photo_file, update.effective_user.username)
+    drafts.discard(update.effective_user.id)
+    if await credit_coins(update.effective_user.id, SIGNUP_BONUS, f"signup:{update.effective_user.id}", "signup") is not None:
+        await update.message.reply_text(f"✅ **All set!** You received **{SIGNUP_BONUS} Free Coins**.\n\nType /search to start chatting!", parse_mode=ParseMode.MARKDOWN)
+    else: await update.message.reply_text("✅ **All set!**\n\nType /search to start chatting!", parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
+@timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    drafts.discard(update.effective_user.id)
     await update.message.reply_text("🚫 Operation canceled.")
     return ConversationHandler.END
 
+# --- RELAY ---
+
+ALBUM_WAIT = 0.5  # seconds to collect the rest of an album before copying it
+relayed_messages = TTLCache(100000, 86400)  # (chat_id, message_id) -> (partner_id, copy_id), for edits
+pending_albums = {}  # (chat_id, media_group_id) -> (partner_id, [message ids])
+
+async def partner_of(user_id):
+    """Current chat partner; a dict lookup unless the session map has to be filled from the user document"""
+    partner_id = chat_sessions.get(user_id)
+    if partner_id is None:
+        user = await get_user(user_id)
+        if user and user.get("status") == "chatting" and user.get("chat_partner"):
+            partner_id = chat_sessions[user_id] = user["chat_partner"]
+    return partner_id
+
+async def relay_message(context, message, partner_id):
+    """Copies any kind of message to the partner with one API call; album parts are batched"""
+    if message.media_group_id:
+        key = (message.chat_id, message.media_group_id)
+        if key not in pending_albums:
+            pending_albums[key] = (partner_id, [])
+            context.application.create_task(flush_album(context.bot, key))
+        pending_albums[key][1].append(message.message_id)
+        return
+    copy = await context.bot.copy_message(partner_id, message.chat_id, message.message_id, protect_content=True, rate_limit_args=RELAY)
+    relayed_messages.set((message.chat_id, message.message_id), (partner_id, copy.message_id))
+
+async def flush_album(bot, key):
+    await asyncio.sleep(ALBUM_WAIT)
+    partner_id, message_ids = pending_albums.pop(key)
+    message_ids.sort()
+    try: copies = await bot.copy_messages(partner_id, key[0], message_ids, protect_content=True, rate_limit_args=RELAY)
+    except Exception as e:
+        logger.debug(f"Album relay to {partner_id} failed: {e}")
+        return
+    for message_id, copy in zip(message_ids, copies): relayed_messages.set((key[0], message_id), (partner_id, copy.message_id))
+
 # --- SEARCH & CHAT ---
 
+@timed_handler
 async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     if update.callback_query: await update.callback_query.answer()
     if not await check_subscription(update, context): return
     
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if not user: return
     update_activity(user_id)
 
     # 1. AUTO-DISCONNECT if already chatting
     if user.get("status") == "chatting":
         # Disconnect from old partner quietly
-        old_partner_id = clear_chat_pair(user_id)
+        old_partner_id = await clear_chat_pair(user_id)
         if old_partner_id:
             try: await context.bot.send_message(old_partner_id, "⚠️ **Partner left to find someone new.**", parse_mode=ParseMode.MARKDOWN)
             except: pass
         # We don't return here, we proceed to search!
 
-    status_msg = await context.bot.send_message(chat_id, "🔎 **Searching for a partner...**", parse_mode=ParseMode.MARKDOWN)
-    await asyncio.sleep(1.5) 
-    partner = find_search_partner(user_id)
-    
-    if partner:
-        await status_msg.delete()
-        set_chat_pair(user_id, partner["_id"])
-        await send_match_message(context, user_id, partner["_id"])
-        await send_match_message(context, partner["_id"], user_id)
-        reset_inactivity_timer(context, user_id, partner["_id"])
+    # 2. Match against the in-memory pool (no await between pick and claim),
+    #    or against Mongo when searchers are spread over several workers
+    my_blocks = await get_blocked_ids(user_id)
+    if SHARDED:
+        partner = await claim_search_partner(user)
+        if not partner:
+            if not await start_search(user_id): return
+            # A searcher who claimed while we were still idle couldn't see us; now that we're searching, try once more
+            partner = await claim_search_partner(user, searching=True)
     else:
-        set_status(user_id, "searching")
-        await status_msg.edit_text("📡 **Looking for a match...**\n(Waiting for someone else to join)")
-        
-        if context.job_queue:
-            # Clear old search timer
-            current_jobs = context.job_queue.get_jobs_by_name(f"search_{user_id}")
-            for job in current_jobs: job.schedule_removal()
-            # Set new 60s timeout
-            context.job_queue.run_once(search_timeout_task, 60, data=user_id, name=f"search_{user_id}")
-
-async def send_match_message(context, to_id, partner_id):
-    partner = get_user(partner_id)
-    text = f"🎉 **PARTNER FOUND!** 🎉\n\n👤 **Name:** {partner.get('name')}, {partner.get('age')}\n⚧ **Gender:** {partner.get('gender')}\n📝 **Bio:** {partner.get('bio')}\n\n💬 **Say 'Hi'!**"
-    keyboard = [
-        [InlineKeyboardButton("👀 View Photo", callback_data=f"view_{partner_id}")],
-        [InlineKeyboardButton("➡️ Next", callback_data="next"), InlineKeyboardButton("🛑 Stop", callback_data="stop")],
-        [InlineKeyboardButton("🚫 Block User", callback_data=f"block_match_{partner_id}")]
-    ]
-    try: await context.bot.send_message(to_id, text, parse_mode=ParseMode.MARKDOWN, reply_markup=InlineKeyboardMarkup(keyboard), protect_content=True)
+        searching = False
+        while True:
+            partner_id = matchmaker.match(user, my_blocks)
+            if partner_id is None:
+                if searching:
+                    # Same tick as the match above, so whoever searches next is bound to see us
+                    matchmaker.enqueue(user, my_blocks)  # 60s timeout is enforced by search_sweep_task
+                    break
+                if not await start_search(user_id): return
+                # Someone may have enqueued during that write, so look once more before joining the pool
+                searching = True
+                continue
+            if await set_chat_pair(user_id, partner_id): break
+            # Lost a race (e.g. a /chat accept landed first); set_chat_pair requeued the partner if they're still waiting
+            user = await get_user(user_id)
+            if not user or user.get("status") == "chatting": return
+            if user_id in matchmaker:  # we were already searching, so set_chat_pair requeued us too
+                partner_id = None
+                break
+        partner = await get_user(partner_id) if partner_id else None
+
+    if partner: await send_match_messages(context, user, partner)
+    else: await context.bot.send_message(chat_id, "📡 **Looking for a match...**\n(Waiting for someone else to join)", parse_mode=ParseMode.MARKDOWN)
+
+async def send_match_message(context, to_id, partner):
+    """Shows to_id the card of the partner document the caller already holds"""
+    text, markup = match_card(partner)
+    try: await context.bot.send_message(to_id, text, parse_mode=ParseMode.MARKDOWN, reply_markup=markup, protect_content=True)
     except: pass
 
+async def send_match_messages(context, user, partner):
+    log_shipper.emit(f"💞 <b>Match</b>\n<code>{user['_id']}</code> ↔ <code>{partner['_id']}</code>")
+    await asyncio.gather(send_match_message(context, user["_id"], partner), send_match_message(context, partner["_id"], user))
+
+@timed_handler
 async def stop_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if update.callback_query: await update.callback_query.answer()
     
-    # Cleanup Jobs
-    if context.job_queue:
-        for prefix in ["search_", "inactivity_"]:
-            current_jobs = context.job_queue.get_jobs_by_name(f"{prefix}{user_id}")
-            for job in current_jobs: job.schedule_removal()
-
-    partner_id = clear_chat_pair(user_id)
-    keyboard = [[InlineKeyboardButton("💬 Find New Partner", callback_data="search")]]
-    await context.bot.send_message(user_id, "🚫 **Chat ended.**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    # Leave the search pool (this also cancels the search timeout); in multi-worker mode only Mongo knows
+    matchmaker.remove(user_id)
+    user = await get_user(user_id)
+    if user and user.get("status") == "searching": await cancel_search(user_id)
+
+    partner_id = await clear_chat_pair(user_id)
+    await context.bot.send_message(user_id, "🚫 **Chat ended.**", reply_markup=FIND_PARTNER_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
     if partner_id:
-        try: await context.bot.send_message(partner_id, "⚠️ **Partner left the chat.**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+        try: await context.bot.send_message(partner_id, "⚠️ **Partner left the chat.**", reply_markup=FIND_PARTNER_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
         except: pass
 
+@timed_handler
 async def next_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # This automatically handles the "Stop & Search New" flow
     await search_handler(update, context)
 
 # --- OTHER HANDLERS (Direct Chat, Block, etc.) ---
 
+@timed_handler
 async def direct_chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not context.args:
         await update.message.reply_text("⚠️ **Usage:** `/chat [ID or @username]`", parse_mode=ParseMode.MARKDOWN)
         return
     target_query = context.args[0]
-    my_user = get_user(user_id)
-    target_user = get_user_by_query(target_query)
+    my_user = await get_user(user_id)
+    target_user = await get_user_by_query(target_query)
     if not target_user:
         await update.message.reply_text("❌ **User not found.**", parse_mode=ParseMode.MARKDOWN)
         return
@@ -413,7 +1561,7 @@ async def direct_chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     if target_id == user_id:
         await update.message.reply_text("❌ Self-chat not allowed.")
         return
-    if is_blocked(user_id, target_id):
+    if await is_blocked(user_id, target_id):
         await update.message.reply_text("🚫 **Blocked.**", parse_mode=ParseMode.MARKDOWN)
         return
     if target_user.get("status") == "chatting":
@@ -430,54 +1578,236 @@ async def direct_chat_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("✅ **Request Sent!**")
     except: await update.message.reply_text("❌ **Failed.**")
 
+@timed_handler
 async def block_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if user and user.get("status") == "chatting" and user.get("chat_partner"):
         partner_id = user["chat_partner"]
-        block_user(user_id, partner_id)
+        await block_user(user_id, partner_id)
         await stop_handler(update, context)
         await update.message.reply_text(f"🚫 **User {partner_id} blocked.**", parse_mode=ParseMode.MARKDOWN)
         return
     if context.args:
         try:
             target_id = int(context.args[0])
-            block_user(user_id, target_id)
+            await block_user(user_id, target_id)
             await update.message.reply_text(f"🚫 **ID {target_id} blocked.**", parse_mode=ParseMode.MARKDOWN)
         except: pass
     else: await update.message.reply_text("⚠️ **Usage:** `/block` in chat or `/block [ID]`", parse_mode=ParseMode.MARKDOWN)
 
+@timed_handler
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    partner_id = await partner_of(user_id)
+    if not partner_id:
+        await update.message.reply_text("⚠️ **Usage:** `/report [reason]` while in a chat", parse_mode=ParseMode.MARKDOWN)
+        return
+    reason = html.escape(" ".join(context.args) or "No reason given")
+    log_shipper.emit(f"⚠️ <b>Report</b>\n<code>{user_id}</code> reported <code>{partner_id}</code>\n📝 {reason}")
+    await update.message.reply_text("✅ **Reported.** Use /block if you don't want to meet them again.", parse_mode=ParseMode.MARKDOWN)
+
+@timed_handler
 async def unblock_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args: return
     try:
         target_id = int(context.args[0])
-        unblock_user(update.effective_user.id, target_id)
+        await unblock_user(update.effective_user.id, target_id)
         await update.message.reply_text(f"✅ **ID {target_id} unblocked.**", parse_mode=ParseMode.MARKDOWN)
     except: pass
 
+@timed_handler
 async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = get_user(update.effective_user.id)
+    user = await get_user(update.effective_user.id)
     if user: await update.message.reply_text(f"💰 **Balance:** `{user.get('coins', 0)}` Coins", parse_mode=ParseMode.MARKDOWN)
 
+@timed_handler
+async def prefs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    user = await get_user(user_id)
+    if not user:
+        await update.message.reply_text("⚠️ Register first with /start")
+        return
+    usage = "⚠️ **Usage:** `/prefs [Male|Female|Any] [min-max]`\ne.g. `/prefs Female 20-30`"
+    if not context.args:
+        age = "-".join(map(str, user["pref_age"])) if user.get("pref_age") else "Any"
+        await update.message.reply_text(f"🎯 **Preferences**\n⚧ Gender: {user.get('pref_gender') or 'Any'}\n🎂 Age: {age}\n\n{usage}", parse_mode=ParseMode.MARKDOWN)
+        return
+    pref_gender, pref_age = None, None
+    for arg in context.args:
+        if arg.capitalize() in ["Male", "Female"]: pref_gender = arg.capitalize()
+        elif arg.lower() == "any": continue
+        else:
+            try: low, high = sorted(int(part) for part in arg.split("-", 1))
+            except ValueError: high = 0
+            # Nobody under 18 is registered, so such a range could never match
+            if high < 18:
+                await update.message.reply_text(usage, parse_mode=ParseMode.MARKDOWN)
+                return
+            pref_age = [max(low, 18), high]
+    await update_profile(user_id, {"pref_gender": pref_gender, "pref_age": pref_age})
+    await update.message.reply_text("✅ **Preferences saved!** They are relaxed automatically if nobody matches for a while.", parse_mode=ParseMode.MARKDOWN)
+
+@timed_handler
 async def referral_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     link = f"https://t.me/{context.bot.username}?start=ref_{user_id}"
     await update.message.reply_text(f"🎁 **Refer & Earn!**\n\n🔗 `{link}`", parse_mode=ParseMode.MARKDOWN)
 
+@timed_handler
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != OWNER_ID: return
-    total = users_collection.count_documents({})
-    searching = users_collection.count_documents({"status": "searching"})
-    chatting = users_collection.count_documents({"status": "chatting"})
-    await update.message.reply_text(f"📊 **Stats**\n\n👥 Users: {total}\n🔎 Searching: {searching}\n💬 Pairs: {chatting // 2}", parse_mode=ParseMode.MARKDOWN)
+    total = await users_collection.estimated_document_count()
+    if SHARDED:
+        # Each worker only sees its own shard, so ask the (indexed) store
+        searching = await users_collection.count_documents({"status": "searching"})
+        pairs = await users_collection.count_documents({"status": "chatting"}) // 2
+    else: searching, pairs = len(matchmaker), len(inactivity)
+    cache_line = f"🗄 Cache: {user_cache.hits} hits / {user_cache.misses} misses ({user_cache.hit_rate():.0%})"
+    send_line = f"📤 Outbound: {rate_limiter.queue_depth()} queued, avg wait {rate_limiter.avg_wait() * 1000:.0f}ms, {rate_limiter.retried} retries, {sum(rate_limiter.errors.values())} errors"
+    sub_line = f"🔐 Sub checks: {sub_cache.hit_rate():.0%} cached, {sub_api_calls_saved()} API calls saved"
+    log_line = f"🧾 Log events: {log_shipper.shipped} shipped, {len(log_shipper)} queued, {log_shipper.dropped} dropped"
+    await update.message.reply_text(f"📊 **Stats**\n\n👥 Users: {total}\n🔎 Searching: {searching}\n💬 Pairs: {pairs}\n{cache_line}\n{send_line}\n{sub_line}\n{log_line}", parse_mode=ParseMode.MARKDOWN)
+
+# --- BROADCAST ---
+
+BROADCAST_BATCH = 200  # ids per checkpoint; a resumed broadcast re-sends at most one batch
+BROADCAST_CONCURRENCY = 25
+BROADCAST_REPORT_INTERVAL = 15  # seconds between progress edits
+
+async def deliver_broadcast(bot, user_id, doc):
+    try:
+        await bot.copy_message(user_id, doc["from_chat"], doc["message_id"], rate_limit_args=BULK)
+        return "sent"
+    except Forbidden: return "blocked"
+    except Exception as e:
+        logger.debug(f"Broadcast to {user_id} failed: {e}")
+        return "failed"
+
+def broadcast_progress(doc, total, elapsed, done_since_start):
+    done = doc["sent"] + doc["failed"] + doc["blocked"]
+    rate = done_since_start / elapsed if elapsed else 0.0
+    eta = f"{max(total - done, 0) / rate / 60:.0f} min" if rate else "?"
+    return (f"📣 **Broadcast** {done}/{total}\n✅ {doc['sent']} sent · 🚫 {doc['blocked']} blocked · ⚠️ {doc['failed']} failed\n"
+            f"⚡ {rate:.1f} msg/s · ⏳ ETA {eta}")
+
+async def run_broadcast(bot, doc):
+    """Copies the stored message to every active user in _id order, checkpointing after each batch"""
+    query = {"inactive": {"$ne": True}}
+    if doc.get("last_id") is not None: query["_id"] = {"$gt": doc["last_id"]}
+    total = doc["sent"] + doc["failed"] + doc["blocked"] + await users_collection.count_documents(query)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    start = last_report = time.monotonic()
+    done_since_start = 0
+
+    async def send(user_id):
+        async with semaphore: return await deliver_broadcast(bot, user_id, doc)
+
+    async def report(suffix=""):
+        text = broadcast_progress(doc, total, time.monotonic() - start, done_since_start) + suffix
+        try: await bot.edit_message_text(text, chat_id=doc["status_chat"], message_id=doc["status_message"], parse_mode=ParseMode.MARKDOWN, rate_limit_args=BULK)
+        except Exception as e: logger.debug(f"Broadcast progress edit failed: {e}")
+
+    async def send_batch(batch):
+        nonlocal done_since_start, last_report
+        results = await asyncio.gather(*(send(user_id) for user_id in batch))
+        blocked = [user_id for user_id, result in zip(batch, results) if result == "blocked"]
+        if blocked:
+            await users_collection.update_many({"_id": {"$in": blocked}}, {"$set": {"inactive": True}})
+            for user_id in blocked: invalidate_user(user_id)
+        counts = Counter(results)
+        for key in ("sent", "failed", "blocked"): doc[key] += counts[key]
+        doc["last_id"] = batch[-1]
+        done_since_start += len(batch)
+        await broadcasts_collection.update_one({"_id": doc["_id"]}, {"$set": {
+            "last_id": doc["last_id"], "sent": doc["sent"], "failed": doc["failed"], "blocked": doc["blocked"]}})
+        if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+            last_report = time.monotonic()
+            await report()
 
+    try:
+        batch = []
+        async for user in users_collection.find(query, {"_id": 1}).sort("_id", ASCENDING).batch_size(BROADCAST_BATCH):
+            batch.append(user["_id"])
+            if len(batch) == BROADCAST_BATCH:
+                await send_batch(batch)
+                batch = []
+        if batch: await send_batch(batch)
+    except asyncio.CancelledError:
+        # on_stop cancels us as well; only an owner cancel ends the broadcast, otherwise it stays running and resumes on restart
+        if doc.get("cancelled"):
+            await broadcasts_collection.update_one({"_id": doc["_id"]}, {"$set": {"state": "cancelled"}})
+            await report("\n\n🛑 Cancelled.")
+        raise
+    await broadcasts_collection.update_one({"_id": doc["_id"]}, {"$set": {"state": "done", "finished": datetime.datetime.now()}})
+    await report("\n\n🏁 Done.")
+    logger.info(f"Broadcast {doc['_id']} finished: {doc['sent']} sent, {doc['blocked']} blocked, {doc['failed']} failed")
+
+def running_broadcast(app):
+    task, doc = app.bot_data.get("broadcast", (None, None))
+    return doc if task and not task.done() else None
+
+def start_broadcast_task(app, doc):
+    if running_broadcast(app): return False
+    # Not app.create_task: Application.stop() waits for those, and a long broadcast would outlive Heroku's 30s grace period
+    task = asyncio.create_task(run_broadcast(app.bot, doc))
+    task.add_done_callback(log_broadcast_failure)
+    app.bot_data["broadcast"] = (task, doc)
+    return True
+
+def log_broadcast_failure(task):
+    if not task.cancelled() and task.exception():
+        logger.error(f"Broadcast failed: {task.exception()!r}")
+
+async def stop_broadcast(app):
+    """Cancels a running broadcast without ending it, so it resumes from its checkpoint on the next start"""
+    if not running_broadcast(app): return
+    task = app.bot_data["broadcast"][0]
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError): await task
+
+async def resume_broadcast(app):
+    """Picks up a broadcast that was still running when the process stopped"""
+    doc = await broadcasts_collection.find_one({"state": "running"}, sort=[("created", -1)])
+    if doc and start_broadcast_task(app, doc):
+        logger.info(f"Resuming broadcast {doc['_id']} after user {doc.get('last_id')}")
+
+@timed_handler
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/broadcast as a reply copies that message to every user; /broadcast cancel stops the running one"""
+    if update.effective_user.id != OWNER_ID: return
+    running = running_broadcast(context.application)
+    if context.args and context.args[0].lower() == "cancel":
+        if running:
+            running["cancelled"] = True
+            context.application.bot_data["broadcast"][0].cancel()
+        else: await update.message.reply_text("No broadcast is running.")
+        return
+    if running:
+        await update.message.reply_text("A broadcast is already running. Use /broadcast cancel first.")
+        return
+    source = update.message.reply_to_message
+    if source is None:
+        await update.message.reply_text("Reply to the message you want to broadcast with /broadcast.")
+        return
+    status = await update.message.reply_text("📣 Broadcast starting…")
+    doc = {
+        "from_chat": source.chat_id, "message_id": source.message_id,
+        "status_chat": status.chat_id, "status_message": status.message_id,
+        "state": "running", "created": datetime.datetime.now(),
+        "last_id": None, "sent": 0, "failed": 0, "blocked": 0,
+    }
+    doc["_id"] = (await broadcasts_collection.insert_one(doc)).inserted_id
+    start_broadcast_task(context.application, doc)
+
+@timed_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data.split("_")
     action = data[0]
 
     if action == "view":
-        target = get_user(int(data[1]))
+        target = await get_user(int(data[1]))
         if target:
             caption = f"👤 **{target.get('name')}**\n{target.get('bio')}"
             try: await context.bot.send_photo(query.from_user.id, target.get("photo_id"), caption=caption, protect_content=True, parse_mode=ParseMode.MARKDOWN)
@@ -497,80 +1827,117 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Type /edit to change your profile.")
     elif action == "check_sub":
         await query.answer()
-        if await check_subscription(update, context):
+        if await check_subscription(update, context, refresh=True):
             await query.message.delete()
             await start(update, context)
         else: await query.message.reply_text("❌ Not joined yet!", ephemeral=True)
     elif action == "block_match":
         target_id = int(data[2]) # format block_match_ID
-        block_user(query.from_user.id, target_id)
+        await block_user(query.from_user.id, target_id)
         await stop_handler(update, context)
         await query.message.reply_text("🚫 **Blocked.**", parse_mode=ParseMode.MARKDOWN)
     elif action == "connect":
         sender_id = int(data[1])
         my_id = query.from_user.id
-        if get_user(sender_id).get("status") == "chatting" or get_user(my_id).get("status") == "chatting":
+        if not await set_chat_pair(my_id, sender_id):
             await query.message.edit_text("❌ Failed.")
             return
-        set_chat_pair(my_id, sender_id)
         await query.message.delete()
-        await send_match_message(context, my_id, sender_id)
-        await send_match_message(context, sender_id, my_id)
-        reset_inactivity_timer(context, my_id, sender_id)
+        me, sender = await asyncio.gather(get_user(my_id), get_user(sender_id))
+        if me and sender: await send_match_messages(context, me, sender)
     elif action == "reject":
         await query.message.delete()
         await context.bot.send_message(query.from_user.id, "❌ **Declined.**")
 
+@timed_handler
 async def chat_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = get_user(user_id)
-    if user and user.get("status") == "chatting" and user.get("chat_partner"):
-        partner_id = user["chat_partner"]
-        reset_inactivity_timer(context, user_id, partner_id)
-        try:
-            if update.message.text: await context.bot.send_message(partner_id, update.message.text, protect_content=True)
-            elif update.message.photo: await context.bot.send_photo(partner_id, update.message.photo[-1].file_id, protect_content=True)
-            elif update.message.sticker: await context.bot.send_sticker(partner_id, update.message.sticker.file_id, protect_content=True)
-            elif update.message.voice: await context.bot.send_voice(partner_id, update.message.voice.file_id, protect_content=True)
-            elif update.message.video: await context.bot.send_video(partner_id, update.message.video.file_id, protect_content=True)
-        except:
+    partner_id = await partner_of(user_id)
+    if partner_id:
+        reset_inactivity_timer(user_id, partner_id)
+        update_activity(user_id)
+        try: await relay_message(context, update.message, partner_id)
+        except Forbidden:
+            # The partner blocked the bot; anything else is this one message failing, not the chat
             await update.message.reply_text("❌ Partner disconnected.")
             await stop_handler(update, context)
+        except Exception as e:
+            logger.warning(f"Relay to {partner_id} failed: {e}")
+            await update.message.reply_text("⚠️ That message couldn't be delivered.")
+
+@timed_handler
+async def edited_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mirrors edits of relayed text and captions onto the partner's copy"""
+    message = update.edited_message
+    copy = relayed_messages.get((message.chat_id, message.message_id))
+    if not copy or await partner_of(update.effective_user.id) != copy[0]: return
+    partner_id, copy_id = copy
+    try:
+        if message.text is not None:
+            await context.bot.edit_message_text(message.text, chat_id=partner_id, message_id=copy_id, entities=message.entities, rate_limit_args=RELAY)
+        elif message.caption is not None:
+            await context.bot.edit_message_caption(chat_id=partner_id, message_id=copy_id, caption=message.caption, caption_entities=message.caption_entities, rate_limit_args=RELAY)
+    except: pass
 
 # --- EDIT PROFILE ---
+@timed_handler
 async def edit_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [["Name", "Age"], ["Gender", "Bio"], ["Photo", "Cancel"]]
-    markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
     text = "✏️ **Edit what?**"
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.message.reply_text(text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
-    else: await update.message.reply_text(text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+        await update.callback_query.message.reply_text(text, reply_markup=EDIT_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
+    else: await update.message.reply_text(text, reply_markup=EDIT_KEYBOARD, parse_mode=ParseMode.MARKDOWN)
     return EDIT_SELECT
 
+@timed_handler
 async def edit_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
     selection = update.message.text
-    if selection == "Cancel": return ConversationHandler.END
-    context.user_data['edit_field'] = selection.lower()
+    if selection == "Cancel":
+        drafts.discard(update.effective_user.id)
+        return ConversationHandler.END
+    drafts.update(update.effective_user.id, edit_field=selection.lower())
     await update.message.reply_text(f"📝 Send new **{selection}**:", reply_markup=ReplyKeyboardRemove(), parse_mode=ParseMode.MARKDOWN)
     return EDIT_UPDATE
 
+@timed_handler
 async def edit_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    field = context.user_data['edit_field']
-    if field == "photo": users_collection.update_one({"_id": user_id}, {"$set": {"photo_id": update.message.photo[-1].file_id}})
+    draft = drafts.get(user_id)
+    if draft is None or draft.edit_field is None:
+        await update.message.reply_text("⌛ That edit expired. Type /edit to start again.")
+        return ConversationHandler.END
+    field = draft.edit_field
+    if field == "photo": await update_profile(user_id, {"photo_id": update.message.photo[-1].file_id})
     else:
         val = update.message.text
         if field == "age": 
             try: val = int(val)
             except: return EDIT_UPDATE
-        users_collection.update_one({"_id": user_id}, {"$set": {field: val}})
+        await update_profile(user_id, {field: val})
+    drafts.discard(user_id)
     await update.message.reply_text("✅ **Updated!**", parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
 
-def main():
-    if not TOKEN: return
-    app = Application.builder().token(TOKEN).build()
+class BotApplication(Application):
+    async def initialize(self):
+        # get_me and the Mongo pool warm up concurrently instead of back to back
+        await asyncio.gather(timed_phase("mongo", warm_up_mongo()), timed_phase("get_me", super().initialize()))
+
+def build_application(with_updater=True, request=None):
+    connect_mongo()
+    builder = (
+        Application.builder().token(TOKEN)
+        .application_class(BotApplication)
+        .rate_limiter(rate_limiter)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if PERSIST_CONVERSATIONS: builder = builder.persistence(MongoPersistence())
+    if request is not None: builder = builder.request(request)  # bench.py plugs in a fake Bot API here
+    if not with_updater: builder = builder.updater(None)
+    app = builder.build()
     
     reg_conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)], 
@@ -578,13 +1945,15 @@ def main():
             REG_NAME: [MessageHandler(filters.TEXT, reg_name)], REG_AGE: [MessageHandler(filters.TEXT, reg_age)], 
             REG_GENDER: [MessageHandler(filters.TEXT, reg_gender)], REG_BIO: [MessageHandler(filters.TEXT, reg_bio)], 
             REG_PHOTO: [MessageHandler(filters.PHOTO, reg_photo)]
-        }, fallbacks=[CommandHandler("cancel", cancel)], allow_reentry=True
+        }, fallbacks=[CommandHandler("cancel", cancel)], allow_reentry=True, conversation_timeout=DRAFT_TTL,
+        name="registration", persistent=PERSIST_CONVERSATIONS
     )
 
     edit_conv = ConversationHandler(
         entry_points=[CommandHandler("edit", edit_start), CallbackQueryHandler(edit_start, pattern="^edit$")],
         states={EDIT_SELECT: [MessageHandler(filters.TEXT, edit_select)], EDIT_UPDATE: [MessageHandler(filters.ALL, edit_update)]},
-        fallbacks=[CommandHandler("cancel", cancel)], allow_reentry=True
+        fallbacks=[CommandHandler("cancel", cancel)], allow_reentry=True, conversation_timeout=DRAFT_TTL,
+        name="edit_profile", persistent=PERSIST_CONVERSATIONS
     )
     
     app.add_handler(reg_conv)
@@ -597,15 +1966,111 @@ def main():
     app.add_handler(CommandHandler("stop", stop_handler))
     app.add_handler(CommandHandler("balance", balance_command))
     app.add_handler(CommandHandler("referral", referral_command))
+    app.add_handler(CommandHandler("prefs", prefs_command))
     app.add_handler(CommandHandler("stats", admin_stats))
+    app.add_handler(CommandHandler("broadcast", broadcast_command))
     app.add_handler(CommandHandler("block", block_command))
     app.add_handler(CommandHandler("unblock", unblock_command))
+    app.add_handler(CommandHandler("report", report_command))
     
     app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO | filters.Sticker.ALL | filters.VOICE | filters.VIDEO, chat_message_handler))
+    # Service messages (pins, joins, ...) can't be copied
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & ~filters.StatusUpdate.ALL, chat_message_handler))
+    app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, edited_message_handler))
     
+    if app.job_queue:
+        app.job_queue.run_repeating(inactivity_sweep_task, interval=INACTIVITY_SWEEP_INTERVAL)
+        app.job_queue.run_repeating(search_sweep_task, interval=SEARCH_SWEEP_INTERVAL)
+        app.job_queue.run_repeating(activity_flush_task, interval=ACTIVITY_FLUSH_INTERVAL)
+        app.job_queue.run_repeating(log_flush_task, interval=LOG_FLUSH_INTERVAL)
+    return app
+
+# --- MULTI-WORKER MODE ---
+
+def handle_shard_message(kind, payload):
+    if kind == "invalidate":
+        user_cache.pop(payload)
+        chat_sessions.pop(payload, None)
+        forget_cards(payload)
+    elif kind == "invalidate_blocks": block_cache.pop(payload)
+    elif kind == "touch": inactivity.touch(tuple(payload))
+
+async def serve_shard(app, inbox):
+    """Feeds this worker's updates and cross-worker messages into its application"""
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        while True:
+            kind, payload = await loop.run_in_executor(None, inbox.get)
+            if kind == "stop": break
+            if kind == "update": await app.update_queue.put(Update.de_json(payload, app.bot))
+            else: handle_shard_message(kind, payload)
+        await app.stop()
+        await app.post_stop(app)
+        await app.post_shutdown(app)
+
+def run_worker(shard, inboxes):
+    global SHARD, shard_inboxes
+    # Heroku signals every process in the dyno; workers shut down cleanly when the router posts "stop" instead
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    SHARD, shard_inboxes = shard, inboxes
+    with startup_phase("build"): app = build_application(with_updater=False)
+    asyncio.run(serve_shard(app, inboxes[shard]))
+
+def spawn_worker(ctx, shard, inboxes):
+    worker = ctx.Process(target=run_worker, args=(shard, inboxes), name=f"worker-{shard}", daemon=True)
+    worker.start()
+    return worker
+
+async def route_updates(ctx, inboxes, workers):
+    """Long-polls Telegram once and hands each update to the worker that owns its user"""
+    # SIGTERM (Heroku's shutdown signal) ends the long poll, so run_sharded can stop the workers in order
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    async with Bot(TOKEN) as bot:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            for shard, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.warning(f"Worker {shard} died, restarting")
+                    workers[shard] = spawn_worker(ctx, shard, inboxes)
+            try: updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception as e:
+                logger.warning(f"get_updates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                user = update.effective_user
+                inboxes[shard_for(user.id) if user else 0].put(("update", update.to_dict()))
+
+def run_sharded():
+    # spawn, not fork: each worker needs its own Mongo client and event loop
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue() for _ in range(WORKERS)]
+    workers = [spawn_worker(ctx, shard, inboxes) for shard in range(WORKERS)]
+    try: asyncio.run(route_updates(ctx, inboxes, workers))
+    except (KeyboardInterrupt, asyncio.CancelledError): pass
+    finally:
+        for inbox in inboxes: inbox.put(("stop", None))
+        # Workers flush concurrently, so they share one deadline
+        deadline = time.monotonic() + SHUTDOWN_GRACE
+        for worker in workers: worker.join(timeout=max(0, deadline - time.monotonic()))
+
+def main():
+    if not TOKEN: return
     print("Bot Running: Auto-Disconnect on Search + Fixed Timeout...")
-    app.run_polling()
+    if SHARDED:
+        run_sharded()
+        return
+    with startup_phase("build"): app = build_application()
+    if WEBHOOK_URL:
+        app.run_webhook(listen="0.0.0.0", port=PORT, url_path="webhook", webhook_url=f"{WEBHOOK_URL.rstrip('/')}/webhook", secret_token=WEBHOOK_SECRET)
+    else: app.run_polling()
+
+startup_phases["import"] = time.perf_counter() - IMPORT_STARTED
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,287 @@
+"""In-memory state behind bot.py: the matchmaking pool, caches, idle timers and drafts.
+
+Standard library only, so tools and tests can import these without the
+telegram or Mongo stack.
+"""
+import time
+from collections import OrderedDict
+
+# --- MATCHMAKING ---
+
+AGE_BAND = 5  # years per bucket
+WIDEN_AGE_AFTER, WIDEN_GENDER_AFTER = 15, 30  # seconds waiting before a preference is relaxed
+MATCH_SCAN_LIMIT = 50  # entries inspected per bucket, so a match stays bounded
+
+class Searcher:
+    """A waiting user's matching attributes, copied out of their document"""
+    __slots__ = ("user_id", "enqueued_at", "gender", "age", "bucket", "pref_gender", "pref_age", "blocked", "stage")
+
+    def __init__(self, user, blocked=(), enqueued_at=None):
+        self.user_id = user["_id"]
+        self.enqueued_at = enqueued_at or time.monotonic()
+        self.gender, self.age = user.get("gender"), user.get("age") or 0
+        self.bucket = (self.gender, self.age // AGE_BAND)
+        self.pref_gender = user.get("pref_gender")
+        self.pref_age = tuple(user["pref_age"]) if user.get("pref_age") else None
+        self.blocked = set(blocked)
+        self.stage = 0
+
+    def widen_stage(self, now):
+        """0 = strict, 1 = any age, 2 = any gender too"""
+        waited = now - self.enqueued_at
+        return 2 if waited >= WIDEN_GENDER_AFTER else 1 if waited >= WIDEN_AGE_AFTER else 0
+
+    def wants_bucket(self, bucket, stage):
+        gender, band = bucket
+        if self.pref_gender and stage < 2 and gender != self.pref_gender: return False
+        if self.pref_age and stage < 1 and not self.pref_age[0] // AGE_BAND <= band <= self.pref_age[1] // AGE_BAND: return False
+        return True
+
+    def accepts(self, other, stage):
+        if other.user_id in self.blocked: return False
+        if self.pref_gender and stage < 2 and other.gender != self.pref_gender: return False
+        if self.pref_age and stage < 1 and not self.pref_age[0] <= other.age <= self.pref_age[1]: return False
+        return True
+
+class Matchmaker:
+    """In-process waiting pool. Mongo only mirrors the "searching" status for durability.
+
+    Searchers sit in one oldest-first dict (for expiry) and in a bucket keyed by
+    (gender, age band). A match only looks at the heads of the buckets the
+    searcher wants, so its cost depends on the number of buckets, not the pool
+    size. Matching never awaits, so two searchers can't claim the same partner.
+    """
+
+    def __init__(self):
+        self.waiting = {}  # user_id -> Searcher
+        self.buckets = {}  # (gender, age band) -> {user_id: Searcher}
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def __contains__(self, user_id):
+        return user_id in self.waiting
+
+    def enqueue(self, user, blocked=(), enqueued_at=None):
+        self.remove(user["_id"])
+        searcher = Searcher(user, blocked, enqueued_at)
+        self.waiting[searcher.user_id] = searcher
+        self.buckets.setdefault(searcher.bucket, {})[searcher.user_id] = searcher
+
+    def remove(self, user_id):
+        searcher = self.waiting.pop(user_id, None)
+        if searcher is None: return False
+        bucket = self.buckets[searcher.bucket]
+        del bucket[user_id]
+        if not bucket: del self.buckets[searcher.bucket]
+        return True
+
+    def add_block(self, user_id, target_id):
+        if user_id in self.waiting: self.waiting[user_id].blocked.add(target_id)
+
+    def expire(self, max_wait):
+        """Pops everyone who has waited longer than max_wait (the pool is oldest-first)"""
+        cutoff = time.monotonic() - max_wait
+        expired = []
+        for user_id, searcher in self.waiting.items():
+            if searcher.enqueued_at > cutoff: break
+            expired.append(user_id)
+        for user_id in expired: self.remove(user_id)
+        return expired
+
+    def match(self, user, blocked=()):
+        """Pops the longest-waiting compatible partner for a user document"""
+        return self._match(Searcher(user, blocked), 0, time.monotonic())
+
+    def _match(self, me, stage, now):
+        best = None
+        for bucket_key, bucket in self.buckets.items():
+            if not me.wants_bucket(bucket_key, stage): continue
+            for scanned, candidate in enumerate(bucket.values()):
+                if scanned >= MATCH_SCAN_LIMIT or (best and candidate.enqueued_at >= best.enqueued_at): break
+                if candidate.user_id != me.user_id and me.accepts(candidate, stage) and candidate.accepts(me, candidate.widen_stage(now)):
+                    best = candidate
+                    break
+        if best is None: return None
+        self.remove(best.user_id)
+        self.remove(me.user_id)
+        return best.user_id
+
+    def rematch_widened(self):
+        """Retries waiters whose preferences just relaxed; returns the new (user, partner) pairs"""
+        now = time.monotonic()
+        due = []
+        for searcher in self.waiting.values():
+            if now - searcher.enqueued_at < WIDEN_AGE_AFTER: break
+            if (searcher.pref_gender or searcher.pref_age) and searcher.widen_stage(now) != searcher.stage: due.append(searcher)
+        pairs = []
+        for searcher in due:
+            searcher.stage = searcher.widen_stage(now)
+            if searcher.user_id not in self.waiting: continue
+            partner_id = self._match(searcher, searcher.stage, now)
+            if partner_id: pairs.append((searcher.user_id, partner_id))
+        return pairs
+
+# --- CACHE ---
+
+class TTLCache:
+    """Bounded LRU map with per-entry expiry and hit/miss counters"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = self.misses = 0
+        self.filling = {}  # key -> [writes seen, fills in flight], only while a fill is in flight
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None: del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    async def fill(self, key, load, ttl=None):
+        """Awaits load() and caches its result, unless `key` was written meanwhile (writes to other keys don't count)"""
+        state = self.filling.setdefault(key, [0, 0])
+        state[1] += 1
+        writes = state[0]
+        try: value = await load()
+        finally:
+            state[1] -= 1
+            if not state[1]: del self.filling[key]
+        if value is not None and state[0] == writes: self.set(key, value, ttl)
+        return value
+
+    def written(self, key):
+        """Marks `key` as changed, so fills already in flight don't cache what they read before the write"""
+        state = self.filling.get(key)
+        if state is not None: state[0] += 1
+
+    def pop(self, key):
+        self.written(key)
+        entry = self.data.pop(key, None)
+        return entry[1] if entry else None
+
+    def peek(self, key):
+        """Returns a live entry without touching LRU order or counters"""
+        entry = self.data.get(key)
+        return entry[1] if entry and entry[0] > time.monotonic() else None
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+# --- INACTIVITY TRACKING ---
+
+class TimerWheel:
+    """Hashed timer wheel of idle deadlines, one entry per chat session.
+
+    touch() only records the new deadline (O(1), no rescheduling); an entry whose
+    slot comes up early is re-filed under its real deadline during expire().
+    """
+
+    def __init__(self, timeout, tick=1.0):
+        self.timeout, self.tick = timeout, tick
+        self.deadlines = {}  # key -> monotonic deadline
+        self.slots = {}  # tick index -> set of keys
+        self.cursor = int(time.monotonic() / tick)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def _file(self, key, deadline):
+        slot = max(int(deadline / self.tick), self.cursor + 1)
+        self.slots.setdefault(slot, set()).add(key)
+
+    def touch(self, key, deadline=None):
+        deadline = deadline or time.monotonic() + self.timeout
+        if key not in self.deadlines: self._file(key, deadline)
+        self.deadlines[key] = deadline
+
+    def discard(self, key):
+        self.deadlines.pop(key, None)
+
+    def expire(self, now=None):
+        """Removes and returns every key whose deadline has passed"""
+        now = now or time.monotonic()
+        expired = []
+        while self.cursor <= int(now / self.tick):
+            for key in self.slots.pop(self.cursor, ()):
+                deadline = self.deadlines.get(key)
+                if deadline is None: continue
+                if deadline <= now:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else: self._file(key, deadline)
+            self.cursor += 1
+        return expired
+
+# --- CONVERSATION STATE ---
+
+class Draft:
+    """Answers collected so far in /start registration or /edit"""
+    FIELDS = ("name", "age", "gender", "bio", "edit_field")
+    __slots__ = FIELDS + ("expires",)
+
+    def __init__(self, **fields):
+        for field in self.FIELDS: setattr(self, field, fields.get(field))
+        self.expires = 0.0
+
+    def to_doc(self):
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+class DraftStore:
+    """Drafts by user id, kept in last-updated order so expiry only ever looks at the front.
+    With persistence on, changed ids collect in `dirty` for a subclass to write behind."""
+
+    def __init__(self, maxsize, ttl, persist):
+        self.maxsize, self.ttl, self.persist = maxsize, ttl, persist
+        self.drafts = {}  # user_id -> Draft, least recently updated first
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.drafts)
+
+    def get(self, user_id):
+        draft = self.drafts.get(int(user_id))
+        return draft if draft is not None and draft.expires > time.monotonic() else None
+
+    def _put(self, user_id, draft, expires):
+        draft.expires = expires
+        self.drafts[user_id] = draft
+        if len(self.drafts) > self.maxsize: del self.drafts[next(iter(self.drafts))]
+
+    def update(self, user_id, **fields):
+        user_id = int(user_id)
+        self.expire()
+        draft = self.drafts.pop(user_id, None) or Draft()
+        for field, value in fields.items(): setattr(draft, field, value)
+        self._put(user_id, draft, time.monotonic() + self.ttl)
+        if self.persist: self.dirty.add(user_id)
+        return draft
+
+    def discard(self, user_id):
+        self.drafts.pop(int(user_id), None)
+        if self.persist: self.dirty.add(int(user_id))
+
+    def expire(self):
+        """Drops drafts past their TTL (Mongo's TTL index does the same for stored ones)"""
+        now = time.monotonic()
+        while self.drafts:
+            user_id = next(iter(self.drafts))
+            if self.drafts[user_id].expires > now: break
+            del self.drafts[user_id]